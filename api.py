@@ -0,0 +1,390 @@
+"""
+HTTP JSON API for match outcome probabilities
+
+POST /simulate with one match, {"home_xg": [0.8], "away_xg": [0.2, 0.2, 0.2, 0.2]}, or many matches at once,
+{"matches": [{"home_xg": ..., "away_xg": ...}, ...]}. Each match can also give home_goals and away_goals (the observed
+score) and home_groups and away_groups (shots sharing a group ID are one chance, see core.group_chances).
+The top level can set "method" to "exact" (the default) or "simulate", with "sims" and "seed" for simulations.
+Simulate requests are rejected if sims x (chances + 1), summed over their matches, exceeds MAX_DRAWS, and any
+request is rejected if its score matrices, (home chances + 1) x (away chances + 1) summed over matches, would
+have more than MAX_SCORE_CELLS elements.
+Each match in the response has home/away xG, home_win, draw, away_win, the exact-score probability matrix
+(element [i][j] is home i - away j) and, if the observed score was given, observed_score_probability.
+GET /health returns {"status": "ok"}.
+
+Exact requests arriving at the same time are micro-batched, so concurrent requests share one vectorised
+core.get_goal_distributions call. The module is a WSGI application, so it runs under any WSGI server, e.g.:
+    gunicorn --workers 4 --threads 16 api:app
+or, for development, with the standard library's server:
+    python api.py --port 8000
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from wsgiref import simple_server
+
+import numpy as np
+
+from functions import core, lookup
+
+METHODS = ["exact", "simulate"]
+
+# limits protecting a worker from a single oversized request
+MAX_BODY_BYTES = 10 * 2**20
+MAX_MATCHES = 10000
+MAX_SHOTS = 200
+MAX_SIMS = 10000000
+# simulate requests are also limited by their total work, the random draws over all matches (about 6s of CPU time)
+MAX_DRAWS = 10**9
+# and every request by the size of its response, the elements of the score matrices over all matches (about 40MB)
+MAX_SCORE_CELLS = 2 * 10**6
+
+MAX_BATCH_SIZE = int(os.environ.get("XG_SIMULATOR_API_BATCH_SIZE", 512))
+MAX_BATCH_WAIT = float(os.environ.get("XG_SIMULATOR_API_BATCH_WAIT", 0.005))
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class MicroBatcher:
+    """
+    Collects exact-probability requests from many threads and calculates them together on a background thread
+    A batch is calculated once it holds max_batch_size matches or max_wait seconds after its first request arrived
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, matches):
+        """
+        Queues a list of (home_xg, away_xg) pairs
+        Returns a future resolving to a list with the home and away goal distributions and home win, draw
+        and away win probabilities of each match
+        """
+
+        future = concurrent.futures.Future()
+        self.requests.put((matches, future))
+
+        # started on first use rather than at import, so each forked server worker gets its own thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        number_of_matches = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+
+        while number_of_matches < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                matches, future = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            batch.append((matches, future))
+            number_of_matches += len(matches)
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            matches = [match for match_list, _ in batch for match in match_list]
+
+            try:
+                home_distributions = core.get_goal_distributions(
+                    [home_xg for home_xg, _ in matches]
+                )
+                away_distributions = core.get_goal_distributions(
+                    [away_xg for _, away_xg in matches]
+                )
+                home_wins, draws, away_wins = core.get_match_probabilities(
+                    home_distributions, away_distributions
+                )
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            results = [
+                (
+                    home_distributions[k, : len(home_xg) + 1],
+                    away_distributions[k, : len(away_xg) + 1],
+                    home_wins[k],
+                    draws[k],
+                    away_wins[k],
+                )
+                for k, (home_xg, away_xg) in enumerate(matches)
+            ]
+
+            start = 0
+            for match_list, future in batch:
+                future.set_result(results[start : start + len(match_list)])
+                start += len(match_list)
+
+
+batcher = MicroBatcher()
+
+
+def parse_xg(match, venue):
+    """
+    Returns a team's total shot xG and the xG of its chances, after combining any grouped shots
+    """
+
+    xg = match.get(venue + "_xg")
+    if not isinstance(xg, list) or len(xg) > MAX_SHOTS:
+        raise BadRequest(f"{venue}_xg must be a list of at most {MAX_SHOTS} xG values")
+    if not all(
+        isinstance(shot_xg, (int, float)) and 0 <= shot_xg <= 1 for shot_xg in xg
+    ):
+        raise BadRequest(f"{venue}_xg values must be numbers between 0 and 1")
+
+    total_xg = sum(xg)
+
+    groups = match.get(venue + "_groups")
+    if groups is not None:
+        if (
+            not isinstance(groups, list)
+            or len(groups) != len(xg)
+            or not all(isinstance(group, (int, str)) for group in groups)
+        ):
+            raise BadRequest(
+                f"{venue}_groups must be a list of IDs the same length as {venue}_xg"
+            )
+        xg = core.group_chances(xg, groups).tolist()
+
+    return total_xg, xg
+
+
+def parse_goals(match, venue):
+    goals = match.get(venue + "_goals")
+    if goals is not None and (
+        not isinstance(goals, int) or isinstance(goals, bool) or goals < 0
+    ):
+        raise BadRequest(f"{venue}_goals must be a non-negative integer")
+
+    return goals
+
+
+def parse_request(body):
+    """
+    Validates a request body, returning the method, number of simulations, seed and list of matches
+    """
+
+    if not isinstance(body, dict):
+        raise BadRequest("request body must be a JSON object")
+
+    method = body.get("method", "exact")
+    if method not in METHODS:
+        raise BadRequest(f"method must be one of {METHODS}")
+
+    number_of_sims = body.get("sims", core.N_SIMS)
+    if not isinstance(number_of_sims, int) or not 0 < number_of_sims <= MAX_SIMS:
+        raise BadRequest(f"sims must be an integer between 1 and {MAX_SIMS}")
+
+    seed = body.get("seed", core.SEED)
+    if not isinstance(seed, int) or seed < 0:
+        raise BadRequest("seed must be a non-negative integer")
+
+    matches = body["matches"] if "matches" in body else [body]
+    if not isinstance(matches, list) or not 0 < len(matches) <= MAX_MATCHES:
+        raise BadRequest(f"matches must be a list of 1 to {MAX_MATCHES} matches")
+
+    parsed_matches = []
+    for match in matches:
+        if not isinstance(match, dict):
+            raise BadRequest("each match must be a JSON object")
+
+        home_total_xg, home_xg = parse_xg(match, "home")
+        away_total_xg, away_xg = parse_xg(match, "away")
+
+        parsed_matches.append(
+            {
+                "home_total_xg": home_total_xg,
+                "away_total_xg": away_total_xg,
+                "home_xg": home_xg,
+                "away_xg": away_xg,
+                "home_goals": parse_goals(match, "home"),
+                "away_goals": parse_goals(match, "away"),
+            }
+        )
+
+    number_of_cells = sum(
+        (len(match["home_xg"]) + 1) * (len(match["away_xg"]) + 1)
+        for match in parsed_matches
+    )
+    if number_of_cells > MAX_SCORE_CELLS:
+        raise BadRequest(
+            f"requests must have at most {MAX_SCORE_CELLS} score matrix elements in total "
+            + "((home chances + 1) x (away chances + 1) summed over matches); use fewer matches"
+        )
+
+    if method == "simulate":
+        # one draw per chance per simulation, plus one per simulation for counting the scoreline
+        number_of_draws = number_of_sims * sum(
+            len(match["home_xg"]) + len(match["away_xg"]) + 1
+            for match in parsed_matches
+        )
+        if number_of_draws > MAX_DRAWS:
+            raise BadRequest(
+                f"simulate requests must have at most {MAX_DRAWS} draws in total "
+                + "(sims x (chances + 1) summed over matches); use fewer sims or matches, or the exact method"
+            )
+
+    return method, number_of_sims, seed, parsed_matches
+
+
+def summarise_match(match, score_matrix, home_win, draw, away_win):
+    observed_score_probability = None
+    if match["home_goals"] is not None and match["away_goals"] is not None:
+        observed_score_probability = float(
+            core.get_score_probability(
+                score_matrix, match["home_goals"], match["away_goals"]
+            )
+        )
+
+    return {
+        "home_xg": match["home_total_xg"],
+        "away_xg": match["away_total_xg"],
+        "home_win": float(home_win),
+        "draw": float(draw),
+        "away_win": float(away_win),
+        "score_matrix": score_matrix.tolist(),
+        "observed_score_probability": observed_score_probability,
+    }
+
+
+def calculate(method, number_of_sims, seed, matches):
+    """
+    Returns the response for each parsed match, micro-batching exact calculations with other requests
+    """
+
+    if method == "exact":
+        results = batcher.submit(
+            [(match["home_xg"], match["away_xg"]) for match in matches]
+        ).result()
+
+        return [
+            summarise_match(
+                match, np.outer(home_distribution, away_distribution), *outcomes
+            )
+            for match, (home_distribution, away_distribution, *outcomes) in zip(
+                matches, results
+            )
+        ]
+
+    responses = []
+    for match in matches:
+        score_counts = core.simulate_match(
+            match["home_xg"], match["away_xg"], number_of_sims, seed
+        )
+        score_matrix = score_counts / score_counts.sum()
+
+        responses.append(
+            summarise_match(
+                match, score_matrix, *core.get_outcome_probabilities(score_matrix)
+            )
+        )
+
+    return responses
+
+
+def json_response(start_response, status, body):
+    payload = json.dumps(body).encode()
+
+    start_response(
+        status,
+        [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(payload))),
+        ],
+    )
+
+    return [payload]
+
+
+def app(environ, start_response):
+    """
+    WSGI application serving GET /health and POST /simulate
+    """
+
+    path = environ.get("PATH_INFO", "")
+    request_method = environ.get("REQUEST_METHOD", "GET")
+
+    if path == "/health" and request_method == "GET":
+        return json_response(start_response, "200 OK", {"status": "ok"})
+
+    if path != "/simulate":
+        return json_response(start_response, "404 Not Found", {"error": "not found"})
+
+    if request_method != "POST":
+        return json_response(
+            start_response,
+            "405 Method Not Allowed",
+            {"error": "use POST with a JSON body"},
+        )
+
+    try:
+        content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        if content_length > MAX_BODY_BYTES:
+            raise BadRequest(f"request body must be at most {MAX_BODY_BYTES} bytes")
+
+        try:
+            body = json.loads(environ["wsgi.input"].read(content_length))
+        except ValueError:
+            raise BadRequest("request body must be valid JSON")
+
+        method, number_of_sims, seed, matches = parse_request(body)
+    except BadRequest as error:
+        return json_response(start_response, "400 Bad Request", {"error": str(error)})
+
+    responses = calculate(method, number_of_sims, seed, matches)
+
+    if "matches" in body:
+        return json_response(start_response, "200 OK", {"matches": responses})
+
+    return json_response(start_response, "200 OK", responses[0])
+
+
+if lookup.LOOKUP_TABLE_DIR:
+    lookup.install(lookup.LOOKUP_TABLE_DIR)
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    with simple_server.make_server(
+        args.host, args.port, app, server_class=ThreadingWSGIServer
+    ) as server:
+        print(f"Serving on http://{args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,10 @@
 import numpy as np
 import pandas as pd
 import streamlit as st
-import streamlit.components.v1 as components
 import matplotlib as mpl
-import matplotlib.pyplot as plt
-import requests
-import io
 import urllib.parse
 
-from functions import simulate
+from functions import fetch, filters, lookup, metrics, render, simulate
 
 # TODO
 # fix fotmob score at end of 90 mins (e.g. WC final 3370572)
@@ -18,12 +14,15 @@ from functions import simulate
 N_SIMS = 100000
 SEED = 0
 
-rng = np.random.default_rng(SEED)
+# smallest number of simulations between progress updates
+PROGRESS_BATCH_SIZE = 10000
 
 mpl.rcParams["figure.dpi"] = 300
 
 st.set_page_config(page_title="xG simulator", page_icon="⚽")
 
+metrics.reset()
+
 streamlit_app_url = "https://single-match-xg-simulator.streamlit.app"
 
 st.title("Single match xG simulator")
@@ -63,6 +62,110 @@ custom_or_understat_or_fotmob = st.radio(
     "Simulate a...", ("FotMob match ID", "Custom match")
 )  # 'Understat match ID',
 
+calculation_method = st.radio(
+    "Calculate match outcomes using...",
+    (
+        "Random simulations",
+        "Random simulations until precise",
+        "Exact probabilities",
+    ),
+    help="Exact probabilities are calculated directly from the xG of each shot, without any simulation noise. "
+    + "Simulating until precise runs batches of simulations until the 95% confidence interval of each outcome is narrow enough",
+)
+
+if calculation_method == "Random simulations":
+    number_of_sims = st.select_slider(
+        "Number of simulations",
+        options=[10000, 100000, 1000000, 10000000],
+        value=N_SIMS,
+        format_func="{:,}".format,
+    )
+
+if calculation_method == "Random simulations until precise":
+    target_interval_width = st.number_input(
+        "Maximum width of 95% confidence intervals (percentage points)",
+        min_value=0.1,
+        max_value=10.0,
+        value=1.0,
+        step=0.1,
+    )
+
+
+@st.cache_resource
+def get_fotmob_fetcher():
+    # one pooled session and response cache shared by every session of the app
+    return fetch.FotMobFetcher()
+
+
+@st.cache_resource
+def install_lookup_table():
+    # precomputed goal distributions are memory-mapped once and shared by every session of the app
+    if lookup.LOOKUP_TABLE_DIR:
+        return lookup.install(lookup.LOOKUP_TABLE_DIR)
+
+
+install_lookup_table()
+
+
+def calculate_match_outcomes(
+    home_xg, away_xg, home_team_observed_goals, away_team_observed_goals
+):
+    if calculation_method == "Exact probabilities":
+        return simulate.get_exact_match_outcomes(home_xg, away_xg)
+
+    if calculation_method == "Random simulations until precise":
+        match_outcomes, standard_errors, sims_used = simulate.simulate_match_adaptive(
+            home_xg,
+            away_xg,
+            home_team_observed_goals,
+            away_team_observed_goals,
+            interval_width=target_interval_width / 100,
+            seed=SEED,
+        )
+
+        st.caption(
+            f"{sims_used:,} simulations run. Standard errors: "
+            + f"home win {standard_errors['home_win']:.2%}, "
+            + f"draw {standard_errors['draw']:.2%}, "
+            + f"away win {standard_errors['away_win']:.2%}, "
+            + f"exact scoreline {standard_errors['actual_score']:.2%}"
+        )
+
+        return match_outcomes
+
+    # show running results while a long simulation is in progress
+    progress_placeholder = st.empty()
+
+    for match_outcomes, sims_so_far in simulate.iter_simulate_match(
+        home_xg,
+        away_xg,
+        number_of_sims,
+        SEED,
+        batch_size=max(PROGRESS_BATCH_SIZE, number_of_sims // 20),
+    ):
+        if sims_so_far < number_of_sims:
+            home_win, draw, away_win = simulate.get_outcome_probabilities(
+                match_outcomes
+            )
+            home_margins, proportions = simulate.get_margin_distribution(match_outcomes)
+
+            with progress_placeholder.container():
+                st.progress(
+                    sims_so_far / number_of_sims,
+                    text=f"{sims_so_far:,} of {number_of_sims:,} simulations: "
+                    + f"home win {home_win:.1%}, draw {draw:.1%}, away win {away_win:.1%}",
+                )
+                st.bar_chart(
+                    pd.DataFrame(
+                        {"Percent of simulations": proportions}, index=home_margins
+                    )
+                )
+
+    progress_placeholder.empty()
+
+    return match_outcomes
+
+
 st.header("Input")
 
 input_flag = False
@@ -71,7 +174,8 @@ if custom_or_understat_or_fotmob == "Custom match":
     input_flag = True
 
     st.caption(
-        "Please enter the xG of each team's shots in the input boxes below.\n\nIndividual xG values should be separated by a comma (',')"
+        "Please enter the xG of each team's shots in the input boxes below.\n\nIndividual xG values should be separated by a comma (',')."
+        + " Shots from the same possession (e.g. a shot and its rebound) can be joined with a '+' (e.g. '0.4+0.3')"
     )
 
     default_value_home_shots_string = "0.8"
@@ -87,23 +191,35 @@ if custom_or_understat_or_fotmob == "Custom match":
         "Away team actual goals scored", min_value=0, step=1, value=1
     )
 
-    home_xg = simulate.xg_to_array(home_shots)
-    away_xg = simulate.xg_to_array(away_shots)
+    home_xg, home_groups = simulate.xg_to_array(home_shots, return_groups=True)
+    away_xg, away_groups = simulate.xg_to_array(away_shots, return_groups=True)
 
     total_home_xg = sum(home_xg)
     total_away_xg = sum(away_xg)
 
-    home_goals = simulate.simulate_chances(rng, N_SIMS, home_xg)
-    away_goals = simulate.simulate_chances(rng, N_SIMS, away_xg)
-    home_margin = home_goals - away_goals
+    group_shots = False
+    if len(set(home_groups)) < len(home_groups) or len(set(away_groups)) < len(
+        away_groups
+    ):
+        group_shots = st.checkbox(
+            "Treat shots joined with a '+' as one chance (at most one goal between them)",
+            value=True,
+        )
+
+    if group_shots:
+        home_xg = simulate.group_chances(home_xg, home_groups)
+        away_xg = simulate.group_chances(away_xg, away_groups)
+
+    match_outcomes = calculate_match_outcomes(
+        home_xg, away_xg, home_team_observed_goals, away_team_observed_goals
+    )
 
     match_date = None
     home_team_name = "Home team"
     away_team_name = "Away team"
     extra_plot_comment = ""
     source = None
-
-    df_match_outcomes = simulate.get_match_outcomes(home_goals, away_goals, home_margin)
+    timeline = None
 
     (
         simulated_home_win_percent,
@@ -111,7 +227,7 @@ if custom_or_understat_or_fotmob == "Custom match":
         simulated_draw_percent,
         percentage_of_sims_matching_actual_score,
     ) = simulate.get_sims_matching_score(
-        df_match_outcomes, home_team_observed_goals, away_team_observed_goals
+        match_outcomes, home_team_observed_goals, away_team_observed_goals
     )
 
 else:  # fotmob
@@ -125,9 +241,6 @@ else:  # fotmob
 
     # cater for teams with no shots?
 
-    url_base = "https://www.fotmob.com/api/"
-    url_match_details = "matchDetails?matchId="
-
     if fotmob_match_id:
         if not fotmob_match_id.isdigit():
             st.write("A FotMob match ID must only contain numbers. Please try again.")
@@ -135,9 +248,7 @@ else:  # fotmob
         else:
             input_flag = True
 
-            url_complete = url_base + url_match_details + fotmob_match_id
-
-            match_summary = requests.get(url_complete).json()
+            match_summary = get_fotmob_fetcher().fetch_match(fotmob_match_id)
 
             if not match_summary["general"]["homeTeam"]["id"]:
                 st.write(
@@ -181,17 +292,16 @@ else:  # fotmob
                 else:
                     source = "fotmob"
 
-                    shot_summary_no_shootout = [
-                        shot
-                        for shot in shot_summary
-                        if shot["period"] != "PenaltyShootout"
-                    ]
+                    shot_table = filters.shot_table_from_fotmob(
+                        shot_summary, home_team_id
+                    )
 
-                    shots_in_extra_time = [
-                        shot
-                        for shot in shot_summary
-                        if shot["period"] in ["FirstHalfExtra", "SecondHalfExtra"]
-                    ]
+                    shots_in_extra_time = np.isin(
+                        shot_table["period"], filters.EXTRA_TIME_PERIODS
+                    ).any()
+                    penalties_not_in_shootout = filters.get_mask(
+                        shot_table, situations=["Penalty"]
+                    ).any()
 
                     extra_plot_comment = ""
 
@@ -203,23 +313,10 @@ else:  # fotmob
                         )
 
                     if simulate_result_90_mins_only:
-                        shot_summary_no_shootout = [
-                            shot
-                            for shot in shot_summary_no_shootout
-                            if shot["period"] in ["FirstHalf", "SecondHalf"]
-                        ]
-
                         extra_plot_comment += (
                             "Result simulated to end of 90 minutes regulation time\n"
                         )
 
-                    penalties_not_in_shootout = [
-                        shot
-                        for shot in shot_summary
-                        if shot["situation"] == "Penalty"
-                        and shot["period"] != "PenaltyShootout"
-                    ]
-
                     exclude_penalties = False
                     if penalties_not_in_shootout:
                         exclude_penalties = st.checkbox(
@@ -228,75 +325,210 @@ else:  # fotmob
                         )
 
                     if exclude_penalties:
-                        shot_summary_no_shootout = [
-                            shot
-                            for shot in shot_summary_no_shootout
-                            if shot["situation"] != "Penalty"
-                        ]
-
                         extra_plot_comment += (
                             "Simulations based on non-penalty xG (NPxG) only"
                         )
 
-                    home_shots_list = [
-                        [
-                            shot["min"],
-                            shot["playerName"],
-                            shot["situation"],
-                            shot["expectedGoals"],
-                            shot["eventType"],
-                        ]
-                        for shot in shot_summary_no_shootout
-                        if shot["teamId"] == home_team_id
+                    red_card_minute = st.number_input(
+                        "Minute of a red card, to compare the game states before and after it (0 for none)",
+                        min_value=0,
+                        max_value=int(shot_table["minute"].max(initial=0)) + 1,
+                        value=0,
+                    )
+
+                    # every combination of the checkboxes is simulated together, so toggling them reuses the same run
+                    variant_options = [
+                        (regulation_only, npxg_only)
+                        for regulation_only in [False, True]
+                        for npxg_only in [False, True]
                     ]
-                    away_shots_list = [
-                        [
-                            shot["min"],
-                            shot["playerName"],
-                            shot["situation"],
-                            shot["expectedGoals"],
-                            shot["eventType"],
-                        ]
-                        for shot in shot_summary_no_shootout
-                        if shot["teamId"] == away_team_id
+                    variant_filters = [
+                        {
+                            "periods": (
+                                filters.REGULATION_PERIODS if regulation_only else None
+                            ),
+                            "exclude_situations": (["Penalty"] if npxg_only else None),
+                        }
+                        for regulation_only, npxg_only in variant_options
                     ]
+                    selected_variant = variant_options.index(
+                        (simulate_result_90_mins_only, exclude_penalties)
+                    )
 
-                    columns = ["Minute", "Player", "Situation", "xG", "Outcome"]
+                    # the game states either side of a red card are extra variants of the selected one
+                    red_card_variants = {}
+                    if red_card_minute:
+                        red_card_variants = filters.get_red_card_variants(
+                            red_card_minute
+                        )
+                        variant_filters.extend(
+                            {**variant_filters[selected_variant], **game_state}
+                            for game_state in red_card_variants.values()
+                        )
 
-                    df_home_shots = pd.DataFrame(home_shots_list, columns=columns)
-                    df_away_shots = pd.DataFrame(away_shots_list, columns=columns)
+                    variant_masks = filters.get_masks(shot_table, variant_filters)
+                    selected_shots = variant_masks[selected_variant]
 
-                    total_home_xg = df_home_shots["xG"].sum()
-                    total_away_xg = df_away_shots["xG"].sum()
+                    columns = ["Minute", "Player", "Situation", "xG", "Outcome"]
 
-                    home_goals = simulate.simulate_chances(
-                        rng, N_SIMS, df_home_shots["xG"]
-                    )
-                    away_goals = simulate.simulate_chances(
-                        rng, N_SIMS, df_away_shots["xG"]
+                    df_shots = pd.DataFrame(
+                        {
+                            column: shot_table[key]
+                            for column, key in zip(
+                                columns,
+                                ["minute", "player", "situation", "xg", "outcome"],
+                            )
+                        }
                     )
-                    home_margin = home_goals - away_goals
 
-                    df_match_outcomes = simulate.get_match_outcomes(
-                        home_goals, away_goals, home_margin
-                    )
+                    df_home_shots = df_shots[
+                        selected_shots & shot_table["is_home"]
+                    ].reset_index(drop=True)
+                    df_away_shots = df_shots[
+                        selected_shots & ~shot_table["is_home"]
+                    ].reset_index(drop=True)
+
+                    home_xg = df_home_shots["xG"].to_numpy()
+                    away_xg = df_away_shots["xG"].to_numpy()
+
+                    total_home_xg = home_xg.sum()
+                    total_away_xg = away_xg.sum()
 
                     home_team_observed_goals = int(home_goals_actual)
                     away_team_observed_goals = int(away_goals_actual)
 
+                    red_card_masks = variant_masks[len(variant_options) :]
+
+                    if calculation_method == "Random simulations":
+                        variant_outcomes = simulate.simulate_variants(
+                            shot_table["xg"],
+                            shot_table["is_home"],
+                            variant_masks,
+                            number_of_sims,
+                            SEED,
+                        )
+                        match_outcomes = variant_outcomes[selected_variant]
+                        red_card_outcomes = variant_outcomes[len(variant_options) :]
+                    else:
+                        match_outcomes = calculate_match_outcomes(
+                            home_xg,
+                            away_xg,
+                            home_team_observed_goals,
+                            away_team_observed_goals,
+                        )
+                        red_card_outcomes = [
+                            simulate.get_exact_match_outcomes(
+                                shot_table["xg"][mask & shot_table["is_home"]],
+                                shot_table["xg"][mask & ~shot_table["is_home"]],
+                            )
+                            for mask in red_card_masks
+                        ]
+
+                    if red_card_variants:
+                        st.subheader("Before and after the red card")
+
+                        st.dataframe(
+                            pd.DataFrame(
+                                [
+                                    [
+                                        shot_table["xg"][
+                                            mask & shot_table["is_home"]
+                                        ].sum(),
+                                        shot_table["xg"][
+                                            mask & ~shot_table["is_home"]
+                                        ].sum(),
+                                        *simulate.get_outcome_probabilities(
+                                            simulate.get_score_matrix(outcomes)
+                                        ),
+                                    ]
+                                    for mask, outcomes in zip(
+                                        red_card_masks, red_card_outcomes
+                                    )
+                                ],
+                                index=list(red_card_variants),
+                                columns=[
+                                    "Home xG",
+                                    "Away xG",
+                                    "Home win",
+                                    "Draw",
+                                    "Away win",
+                                ],
+                            )
+                            .style.format(
+                                "{:.1%}", subset=["Home win", "Draw", "Away win"]
+                            )
+                            .format("{:.2f}", subset=["Home xG", "Away xG"])
+                        )
+
                     (
                         simulated_home_win_percent,
                         simulated_away_win_percent,
                         simulated_draw_percent,
                         percentage_of_sims_matching_actual_score,
                     ) = simulate.get_sims_matching_score(
-                        df_match_outcomes,
+                        match_outcomes,
                         home_team_observed_goals,
                         away_team_observed_goals,
                     )
 
+                    selected_is_home = shot_table["is_home"][selected_shots]
+                    selected_shot_table = {
+                        column: values[selected_shots]
+                        for column, values in shot_table.items()
+                    }
+                    timeline = simulate.get_timeline(
+                        selected_shot_table["xg"][selected_is_home],
+                        selected_shot_table["minute"][selected_is_home],
+                        selected_shot_table["xg"][~selected_is_home],
+                        selected_shot_table["minute"][~selected_is_home],
+                        selected_shot_table["outcome"][selected_is_home] == "Goal",
+                        selected_shot_table["outcome"][~selected_is_home] == "Goal",
+                    )
+
                     st.header("Shot details")
 
+                    show_attribution = st.checkbox(
+                        "Show each shot's and player's contribution to the result",
+                        value=False,
+                    )
+
+                    if show_attribution:
+                        # attribution needs simulated shot outcomes, so it is simulated even when the match
+                        # outcomes are calculated another way, and its columns say so
+                        win_probability_label = "Win probability added"
+                        scored_label = "Scored at least once"
+                        if calculation_method == "Random simulations":
+                            attribution_sims = number_of_sims
+                        else:
+                            attribution_sims = N_SIMS
+                            win_probability_label += " (simulated)"
+                            scored_label += " (simulated)"
+
+                        # every figure comes from one simulation of every shot's outcome
+                        attribution = simulate.get_shot_attribution(
+                            selected_shot_table["xg"],
+                            selected_is_home,
+                            selected_shot_table["player"],
+                            attribution_sims,
+                            SEED,
+                        )
+
+                        for df_team_shots, team_shots in [
+                            (df_home_shots, selected_is_home),
+                            (df_away_shots, ~selected_is_home),
+                        ]:
+                            df_team_shots["Scored in sims"] = attribution[
+                                "goal_probability"
+                            ][team_shots]
+                            df_team_shots[win_probability_label] = attribution[
+                                "win_probability_added"
+                            ][team_shots]
+
+                        st.caption(
+                            "Win probability added is how much lower the team's chance of winning would be without the shot. "
+                            + f"Contributions are estimated from {attribution_sims:,} simulations"
+                        )
+
                     st.subheader(home_team_name + " (home)")
 
                     st.dataframe(df_home_shots)
@@ -305,13 +537,28 @@ else:  # fotmob
 
                     st.dataframe(df_away_shots)
 
+                    if show_attribution:
+                        st.subheader("Players")
+
+                        st.dataframe(
+                            pd.DataFrame(
+                                {
+                                    "Player": attribution["players"],
+                                    "xG": attribution["player_xg"],
+                                    "Simulated goals": attribution["player_goals"],
+                                    scored_label: attribution[
+                                        "player_scored_probability"
+                                    ],
+                                }
+                            ).sort_values("xG", ascending=False),
+                            hide_index=True,
+                        )
+
 if input_flag:
     st.header("Match outcomes")
 
-    img = io.BytesIO()
-
-    fig, ax, plot_title = simulate.plot_margins(
-        df_match_outcomes,
+    img, plot_title = render.render_margins(
+        match_outcomes,
         home_team_observed_goals,
         away_team_observed_goals,
         simulated_home_win_percent,
@@ -324,12 +571,23 @@ if input_flag:
         home_team=home_team_name,
         away_team=away_team_name,
         extra_plot_comment=extra_plot_comment,
-        io=img,
         source=source,
         app_url=streamlit_app_url,
     )
 
-    st.pyplot(fig=fig)
+    if timeline is None:
+        st.image(img, width="stretch")
+    else:
+        margins_column, timeline_column = st.columns(2)
+
+        with margins_column:
+            st.image(img, width="stretch")
+
+        with timeline_column:
+            st.image(
+                render.render_timeline(timeline, home_team_name, away_team_name),
+                width="stretch",
+            )
 
     file_name = "simulated_xg.png"
 
@@ -340,6 +598,9 @@ if input_flag:
         mime="image/png",
     )
 
+    # only needed once there is a plot to share, so imported here rather than at startup
+    import streamlit.components.v1 as components
+
     # data-related="lyonjust"
     # data-via="lyonjust"
     # data-hashtags="xg_simulator"
@@ -361,6 +622,91 @@ if input_flag:
     """
     )
 
-    fig, ax = simulate.plot_exact_scores(df_match_outcomes)
+    show_exact_scores = st.checkbox(
+        "Show the likelihood of every exact scoreline", value=False
+    )
 
-    st.pyplot(fig=fig)
+    if show_exact_scores:
+        st.image(render.render_exact_scores(match_outcomes), width="stretch")
+
+    with st.expander(
+        "How sensitive are these probabilities to errors in the xG values?"
+    ):
+        st.caption(
+            "xG values are estimates from a model, so each scenario perturbs the xG of every chance and "
+            + "recalculates the exact probabilities. The bands show the middle 90% of scenarios."
+        )
+
+        perturbation = st.radio(
+            "Model the xG error as...",
+            simulate.PERTURBATIONS,
+            format_func={
+                "beta": "Independent noise on each chance",
+                "calibration": "A miscalibrated xG model",
+            }.get,
+            horizontal=True,
+        )
+
+        if perturbation == "beta":
+            concentration = st.slider(
+                "Confidence in each xG value (higher is less noise)",
+                min_value=5,
+                max_value=200,
+                value=50,
+            )
+            slope_sd = intercept_sd = 0.0
+        else:
+            concentration = 50
+            slope_sd = st.slider(
+                "Standard deviation of the calibration slope",
+                min_value=0.0,
+                max_value=0.5,
+                value=0.1,
+            )
+            intercept_sd = st.slider(
+                "Standard deviation of the calibration intercept (log-odds)",
+                min_value=0.0,
+                max_value=0.5,
+                value=0.1,
+            )
+
+        number_of_scenarios = st.select_slider(
+            "Number of scenarios", options=[100, 1000, 10000], value=1000
+        )
+
+        sweep_bands = simulate.get_sweep_bands(
+            simulate.sweep_xg_uncertainty(
+                home_xg,
+                away_xg,
+                home_team_observed_goals,
+                away_team_observed_goals,
+                number_of_scenarios,
+                perturbation,
+                concentration,
+                slope_sd,
+                intercept_sd,
+                seed=SEED,
+            )
+        )
+
+        st.dataframe(
+            pd.DataFrame(
+                sweep_bands.values(),
+                index=["Home win", "Draw", "Away win", "Exact scoreline observed"],
+                columns=["Low (5%)", "Median", "High (95%)"],
+            ).style.format("{:.1%}")
+        )
+
+if metrics.ENABLED:
+    with st.expander("Debug: time and memory by stage"):
+        df_stage_metrics = pd.DataFrame(
+            metrics.get_records(),
+            columns=[
+                "stage",
+                "seconds",
+                "peak_memory_bytes",
+                "retained_memory_bytes",
+            ],
+        )
+        st.dataframe(df_stage_metrics)
+        st.dataframe(df_stage_metrics.groupby("stage", sort=False)[["seconds"]].sum())
@@ -0,0 +1,743 @@
+"""
+Headless batch simulation of many matches from a file of shots
+
+Shots are read from a CSV, JSONL or Parquet file with one row per shot and the columns
+match_id, team and xG, plus optionally period, situation, venue ("home"/"away"), outcome ("Goal" for scored shots)
+and possession (shots sharing a possession ID within a match, e.g. a shot and its rebound, count as one chance).
+Rows must be grouped by match_id. Without a venue column, the first team listed for a match is treated as the home team.
+
+Examples:
+    python batch.py simulate shots.csv --output results.csv
+    python batch.py table shots.csv --output table.csv --positions positions.csv
+    python batch.py fetch 3854572 3854573 --output-dir matches/
+    python batch.py store --fixtures matches/ --output store/
+    python batch.py simulate store/ --output results.csv
+    python batch.py lookup shots.csv --quantum 0.001 --output lookup/
+    python batch.py simulate shots.csv --lookup-table lookup/ --output results.csv
+    python batch.py export store/ --formats png webp --dpi 300 --output-dir graphics/
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+from functions import core, export, fetch, filters, lookup, shot_store, xpts
+
+RESULT_COLUMNS = [
+    "match_id",
+    "home_team",
+    "away_team",
+    "home_xg",
+    "away_xg",
+    "home_goals",
+    "away_goals",
+    "home_win",
+    "draw",
+    "away_win",
+    "actual_score_probability",
+]
+
+
+def read_shots(path, chunksize=100000):
+    """
+    Yields DataFrames of at most chunksize shots read from a CSV, JSONL or Parquet file
+    """
+
+    suffix = pathlib.Path(path).suffix.lower()
+
+    if suffix == ".csv":
+        yield from pd.read_csv(path, chunksize=chunksize)
+    elif suffix in [".jsonl", ".ndjson"]:
+        yield from pd.read_json(path, lines=True, chunksize=chunksize)
+    elif suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported shots file type: {suffix}")
+
+
+def iter_matches(shot_chunks):
+    """
+    Groups a stream of shot chunks into one DataFrame per match, holding at most one chunk plus one match in memory
+    """
+
+    seen_match_ids = set()
+    carried_shots = None
+
+    for shots in shot_chunks:
+        if carried_shots is not None:
+            shots = pd.concat([carried_shots, shots], ignore_index=True)
+
+        # a match ID starting more than one run of rows within the chunk is also ungrouped
+        run_match_ids = shots["match_id"][
+            shots["match_id"].ne(shots["match_id"].shift())
+        ]
+        if run_match_ids.duplicated().any():
+            match_id = run_match_ids[run_match_ids.duplicated()].iloc[0]
+            raise ValueError(f"Shots for match {match_id} are not grouped together")
+
+        # the last match in a chunk may continue in the next one
+        last_match_id = shots["match_id"].iloc[-1]
+        is_last_match = (shots["match_id"] == last_match_id).to_numpy()
+        carried_shots = shots[is_last_match]
+
+        for match_id, match_shots in shots[~is_last_match].groupby(
+            "match_id", sort=False
+        ):
+            if match_id in seen_match_ids:
+                raise ValueError(f"Shots for match {match_id} are not grouped together")
+            seen_match_ids.add(match_id)
+
+            yield match_id, match_shots
+
+    if carried_shots is not None and len(carried_shots):
+        match_id = carried_shots["match_id"].iloc[0]
+        if match_id in seen_match_ids:
+            raise ValueError(f"Shots for match {match_id} are not grouped together")
+
+        yield match_id, carried_shots
+
+
+def filter_shots(match_shots, regulation_only=False, exclude_penalties=False):
+    """
+    Drops penalty shootout kicks, and optionally extra time shots and penalties, with the same filters.get_mask
+    filters as the app. Filters on a period or situation column are skipped if the file has no such column
+    """
+
+    shot_table = {"xg": match_shots["xG"].to_numpy()}
+    mask_filters = {"exclude_periods": None}
+
+    if "period" in match_shots:
+        shot_table["period"] = match_shots["period"].to_numpy()
+        mask_filters["exclude_periods"] = filters.PENALTY_SHOOTOUT_PERIODS
+        if regulation_only:
+            mask_filters["periods"] = filters.REGULATION_PERIODS
+
+    if exclude_penalties and "situation" in match_shots:
+        shot_table["situation"] = match_shots["situation"].to_numpy()
+        mask_filters["exclude_situations"] = ["Penalty"]
+
+    return match_shots[filters.get_mask(shot_table, **mask_filters)]
+
+
+def split_teams(match_shots):
+    """
+    Returns the home and away team names for a match's shots
+    """
+
+    if "venue" in match_shots:
+        venues = match_shots.groupby("venue", sort=False)["team"].first()
+        return venues.get("home"), venues.get("away")
+
+    teams = match_shots["team"].unique()
+    return teams[0], (teams[1] if len(teams) > 1 else None)
+
+
+def summarise_match(match_id, match_shots, regulation_only, exclude_penalties):
+    home_team, away_team = split_teams(match_shots)
+
+    shots = filter_shots(match_shots, regulation_only, exclude_penalties)
+
+    home_shots = shots[shots["team"] == home_team]
+    away_shots = shots[shots["team"] == away_team]
+
+    match = {
+        "match_id": match_id,
+        "home_team": home_team,
+        "away_team": away_team,
+        "home_xg": home_shots["xG"].sum(),
+        "away_xg": away_shots["xG"].sum(),
+        "home_xg_list": home_shots["xG"].to_numpy(dtype=float),
+        "away_xg_list": away_shots["xG"].to_numpy(dtype=float),
+        "home_goals": np.nan,
+        "away_goals": np.nan,
+    }
+
+    if "possession" in shots:
+        match["home_xg_list"] = core.group_chances(
+            match["home_xg_list"],
+            shot_store.get_possession_groups(
+                shot_store.get_possession_codes(home_shots["possession"])
+            ),
+        )
+        match["away_xg_list"] = core.group_chances(
+            match["away_xg_list"],
+            shot_store.get_possession_groups(
+                shot_store.get_possession_codes(away_shots["possession"])
+            ),
+        )
+
+    # like the app, excluding penalties only changes the xG, so the observed score keeps penalty goals
+    if "outcome" in shots:
+        score_shots = filter_shots(match_shots, regulation_only)
+        scored = score_shots["outcome"] == "Goal"
+        match["home_goals"] = int((scored & (score_shots["team"] == home_team)).sum())
+        match["away_goals"] = int((scored & (score_shots["team"] == away_team)).sum())
+
+    return match
+
+
+def get_actual_score_probability(score_matrix, match):
+    if np.isnan(match["home_goals"]):
+        return np.nan
+
+    return core.get_score_probability(
+        score_matrix, match["home_goals"], match["away_goals"]
+    )
+
+
+def simulate_matches(matches, method="exact", number_of_sims=core.N_SIMS):
+    """
+    Calculates outcome probabilities for a list of matches from summarise_match
+    Returns a DataFrame with RESULT_COLUMNS
+    """
+
+    df_results = pd.DataFrame(
+        {
+            "match_id": [match["match_id"] for match in matches],
+            "home_team": [match["home_team"] for match in matches],
+            "away_team": [match["away_team"] for match in matches],
+            "home_xg": [match["home_xg"] for match in matches],
+            "away_xg": [match["away_xg"] for match in matches],
+            "home_goals": [match["home_goals"] for match in matches],
+            "away_goals": [match["away_goals"] for match in matches],
+        }
+    )
+
+    if method == "exact":
+        home_distributions = core.get_goal_distributions(
+            [match["home_xg_list"] for match in matches]
+        )
+        away_distributions = core.get_goal_distributions(
+            [match["away_xg_list"] for match in matches]
+        )
+
+        (
+            df_results["home_win"],
+            df_results["draw"],
+            df_results["away_win"],
+        ) = core.get_match_probabilities(home_distributions, away_distributions)
+
+        df_results["actual_score_probability"] = [
+            get_actual_score_probability(
+                np.outer(home_distributions[k], away_distributions[k]), match
+            )
+            for k, match in enumerate(matches)
+        ]
+
+    else:
+        probabilities = []
+        for match in matches:
+            score_matrix = core.get_score_matrix(
+                core.simulate_match(
+                    match["home_xg_list"], match["away_xg_list"], number_of_sims
+                )
+            )
+            home_win, draw, away_win = core.get_outcome_probabilities(score_matrix)
+
+            actual_score_probability = get_actual_score_probability(score_matrix, match)
+
+            probabilities.append([home_win, draw, away_win, actual_score_probability])
+
+        df_results[["home_win", "draw", "away_win", "actual_score_probability"]] = (
+            np.array(probabilities).reshape(-1, 4)
+        )
+
+    return df_results[RESULT_COLUMNS]
+
+
+def summarise_store_match(store, match_id, regulation_only, exclude_penalties):
+    """
+    Equivalent of summarise_match for a match in a shot store, filtering on category codes
+    """
+
+    home_team, away_team = store.get_team_names(match_id)
+
+    match = {
+        "match_id": match_id,
+        "home_team": home_team,
+        "away_team": away_team,
+    }
+
+    # filters.get_mask compares values with np.isin, so it works on category codes as well as on names
+    def get_codes(column, values):
+        return [store.get_code(column, value) for value in values]
+
+    mask_filters = {
+        "exclude_periods": get_codes("period", filters.PENALTY_SHOOTOUT_PERIODS)
+    }
+    if regulation_only:
+        mask_filters["periods"] = get_codes("period", filters.REGULATION_PERIODS)
+    # like the app, excluding penalties only changes the xG, so the observed score keeps penalty goals
+    score_filters = dict(mask_filters)
+    if exclude_penalties:
+        mask_filters["exclude_situations"] = get_codes("situation", ["Penalty"])
+
+    for venue, shots in zip(["home", "away"], store.get_match_shots(match_id)):
+        keep = filters.get_mask(shots, **mask_filters)
+        match[venue + "_goals"] = int(
+            shots["is_goal"][filters.get_mask(shots, **score_filters)].sum()
+        )
+
+        xg = shots["xg"] if keep.all() else shots["xg"][keep]
+        match[venue + "_xg"] = xg.sum()
+        match[venue + "_xg_list"] = xg
+
+        # shots without a possession ID hold -1 and are chances of their own, so only
+        # teams with at least one possession ID need grouping
+        possession = shots["possession"][keep]
+        if (possession >= 0).any():
+            match[venue + "_xg_list"] = core.group_chances(
+                xg, shot_store.get_possession_groups(possession)
+            )
+
+    return match
+
+
+def iter_match_batches(args):
+    """
+    Yields lists of at most args.batch_size matches from summarise_match, read from args.shots
+    (a shots file, or a shot store directory written by batch.py store)
+    """
+
+    if pathlib.Path(args.shots).is_dir():
+        store = shot_store.ShotStore(args.shots)
+        summarised_matches = (
+            summarise_store_match(
+                store, match_id, args.regulation_only, args.exclude_penalties
+            )
+            for match_id in store.match_ids.tolist()
+        )
+    else:
+        shot_chunks = read_shots(args.shots, chunksize=args.chunksize)
+        summarised_matches = (
+            summarise_match(
+                match_id, match_shots, args.regulation_only, args.exclude_penalties
+            )
+            for match_id, match_shots in iter_matches(shot_chunks)
+        )
+
+    matches = []
+    for match in summarised_matches:
+        matches.append(match)
+
+        if len(matches) == args.batch_size:
+            yield matches
+            matches = []
+
+    if matches:
+        yield matches
+
+
+def open_output(path):
+    if path:
+        return open(path, "w", newline="")
+
+    return contextlib.nullcontext(sys.stdout)
+
+
+def run_simulate(args):
+    with open_output(args.output) as output:
+        write_header = True
+
+        for matches in iter_match_batches(args):
+            df_results = simulate_matches(matches, args.method, args.sims)
+            df_results.to_csv(output, index=False, header=write_header)
+            write_header = False
+
+        if write_header:
+            pd.DataFrame(columns=RESULT_COLUMNS).to_csv(output, index=False)
+
+
+def run_table(args):
+    results = []
+    home_teams = []
+    away_teams = []
+    home_xg_lists = []
+    away_xg_lists = []
+
+    for matches in iter_match_batches(args):
+        results.append(simulate_matches(matches))
+        home_teams.extend(match["home_team"] for match in matches)
+        away_teams.extend(match["away_team"] for match in matches)
+        home_xg_lists.extend(match["home_xg_list"] for match in matches)
+        away_xg_lists.extend(match["away_xg_list"] for match in matches)
+
+    df_results = pd.concat(results, ignore_index=True)
+
+    with open_output(args.output) as output:
+        xpts.get_xpts_table(df_results).to_csv(output)
+
+    if args.positions:
+        df_positions = xpts.simulate_season(
+            home_teams,
+            away_teams,
+            core.get_goal_distributions(home_xg_lists),
+            core.get_goal_distributions(away_xg_lists),
+            number_of_sims=args.sims,
+        )
+        df_positions.to_csv(args.positions)
+
+
+def run_fetch(args):
+    match_ids = list(args.match_ids)
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            match_ids.extend(line.strip() for line in f if line.strip())
+
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    fetcher = fetch.FotMobFetcher(
+        base_url=args.base_url, pool_size=args.concurrency, timeout=args.timeout
+    )
+    responses = fetcher.fetch_matches(match_ids, concurrency=args.concurrency)
+
+    failures = 0
+    for match_id, match_summary in responses.items():
+        if isinstance(match_summary, Exception):
+            print(f"Failed to fetch match {match_id}: {match_summary}", file=sys.stderr)
+            failures += 1
+            continue
+
+        with open(output_dir / f"{match_id}.json", "w") as f:
+            json.dump(match_summary, f)
+
+    if failures:
+        sys.exit(1)
+
+
+def run_store(args):
+    if args.fixtures:
+        fetcher = fetch.FixtureFetcher(args.fixtures)
+        df_shots = pd.concat(
+            [
+                shot_store.shots_from_fotmob(fetcher.fetch_match(path.stem))
+                for path in sorted(pathlib.Path(args.fixtures).glob("*.json"))
+            ],
+            ignore_index=True,
+        )
+    else:
+        df_shots = pd.concat(read_shots(args.shots), ignore_index=True)
+
+    if "venue" not in df_shots:
+        home_teams = {
+            match_id: split_teams(match_shots)[0]
+            for match_id, match_shots in df_shots.groupby("match_id", sort=False)
+        }
+        df_shots["venue"] = np.where(
+            df_shots["team"] == df_shots["match_id"].map(home_teams), "home", "away"
+        )
+
+    shot_store.build_shot_store(df_shots, args.output)
+
+
+def run_lookup(args):
+    xg_lists = [
+        lookup.DEFAULT_PROFILES,
+        lookup.iter_round_profiles(max_shots=args.max_shots),
+    ]
+
+    if args.shots:
+        xg_lists.extend(
+            [match["home_xg_list"], match["away_xg_list"]]
+            for matches in iter_match_batches(args)
+            for match in matches
+        )
+
+    number_of_profiles = lookup.build_lookup_table(
+        args.output, itertools.chain.from_iterable(xg_lists), args.quantum
+    )
+
+    print(f"Wrote {number_of_profiles} profiles to {args.output}", file=sys.stderr)
+
+
+def get_score_matrices(matches, method="exact", number_of_sims=core.N_SIMS):
+    """
+    Returns the exact or simulated scoreline table of each match from summarise_match
+    """
+
+    if method == "exact":
+        home_distributions = core.get_goal_distributions(
+            [match["home_xg_list"] for match in matches]
+        )
+        away_distributions = core.get_goal_distributions(
+            [match["away_xg_list"] for match in matches]
+        )
+
+        return [
+            np.outer(
+                home_distributions[k, : len(match["home_xg_list"]) + 1],
+                away_distributions[k, : len(match["away_xg_list"]) + 1],
+            )
+            for k, match in enumerate(matches)
+        ]
+
+    return [
+        core.get_score_matrix(
+            core.simulate_match(
+                match["home_xg_list"], match["away_xg_list"], number_of_sims
+            )
+        )
+        for match in matches
+    ]
+
+
+def run_export(args):
+    written = 0
+    skipped = 0
+
+    for matches in iter_match_batches(args):
+        score_matrices = get_score_matrices(matches, args.method, args.sims)
+
+        export_matches = [
+            {
+                "match_id": match["match_id"],
+                "score_matrix": score_matrix,
+                "home_team": match["home_team"] or "Home team",
+                "away_team": match["away_team"] or "Away team",
+                "home_xg": match["home_xg"],
+                "away_xg": match["away_xg"],
+                "home_goals": match["home_goals"],
+                "away_goals": match["away_goals"],
+            }
+            for match, score_matrix in zip(matches, score_matrices)
+        ]
+
+        batch_written, batch_skipped = export.export_margins(
+            export_matches,
+            args.output_dir,
+            formats=args.formats,
+            dpi=args.dpi,
+            workers=args.workers,
+            app_url=args.app_url,
+        )
+        written += batch_written
+        skipped += batch_skipped
+
+    print(f"Wrote {written} files, skipped {skipped} unchanged", file=sys.stderr)
+
+
+def add_shots_arguments(parser):
+    parser.add_argument(
+        "shots",
+        help="CSV, JSONL or Parquet file of shots, or a shot store directory from batch.py store",
+    )
+    parser.add_argument(
+        "--regulation-only",
+        action="store_true",
+        help="Ignore extra time shots (simulate the result at the end of 90 minutes)",
+    )
+    parser.add_argument(
+        "--exclude-penalties",
+        action="store_true",
+        help="Ignore penalties awarded (simulate NPxG)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=100000,
+        help="Number of shots read from the file at a time",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of matches calculated at a time",
+    )
+    parser.add_argument(
+        "--lookup-table",
+        default=lookup.LOOKUP_TABLE_DIR,
+        help="Directory of precomputed goal distributions from batch.py lookup",
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    simulate_parser = subparsers.add_parser(
+        "simulate",
+        help="Calculate outcome probabilities for every match in a shots file",
+    )
+    add_shots_arguments(simulate_parser)
+    simulate_parser.add_argument(
+        "--output", "-o", help="CSV file to write results to (default: stdout)"
+    )
+    simulate_parser.add_argument(
+        "--method",
+        choices=["exact", "simulate"],
+        default="exact",
+        help="Calculate exact probabilities or run random simulations (default: exact)",
+    )
+    simulate_parser.add_argument(
+        "--sims",
+        type=int,
+        default=core.N_SIMS,
+        help="Number of simulations per match with --method simulate",
+    )
+    simulate_parser.set_defaults(func=run_simulate)
+
+    table_parser = subparsers.add_parser(
+        "table", help="Build an expected points (xPts) league table from a shots file"
+    )
+    add_shots_arguments(table_parser)
+    table_parser.add_argument(
+        "--output", "-o", help="CSV file to write the table to (default: stdout)"
+    )
+    table_parser.add_argument(
+        "--positions",
+        help="CSV file to write each team's probability of finishing in each position to",
+    )
+    table_parser.add_argument(
+        "--sims",
+        type=int,
+        default=10000,
+        help="Number of simulated seasons used for --positions",
+    )
+    table_parser.set_defaults(func=run_table)
+
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="Download FotMob match details concurrently to a directory"
+    )
+    fetch_parser.add_argument("match_ids", nargs="*", help="FotMob match IDs")
+    fetch_parser.add_argument("--ids-file", help="File with one match ID per line")
+    fetch_parser.add_argument(
+        "--output-dir",
+        "-o",
+        required=True,
+        help="Directory to save <match_id>.json files to",
+    )
+    fetch_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=fetch.DEFAULT_CONCURRENCY,
+        help="Maximum number of requests in flight",
+    )
+    fetch_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=fetch.DEFAULT_TIMEOUT,
+        help="Seconds to wait for each response",
+    )
+    fetch_parser.add_argument(
+        "--base-url", default=fetch.FOTMOB_API_URL, help="API base URL"
+    )
+    fetch_parser.set_defaults(func=run_fetch)
+
+    store_parser = subparsers.add_parser(
+        "store", help="Build a memory-mapped columnar shot store for fast reprocessing"
+    )
+    store_source = store_parser.add_mutually_exclusive_group(required=True)
+    store_source.add_argument(
+        "--shots", help="CSV, JSONL or Parquet file of shots to store"
+    )
+    store_source.add_argument(
+        "--fixtures", help="Directory of FotMob match details from batch.py fetch"
+    )
+    store_parser.add_argument(
+        "--output", "-o", required=True, help="Directory to write the store to"
+    )
+    store_parser.set_defaults(func=run_store)
+
+    lookup_parser = subparsers.add_parser(
+        "lookup",
+        help="Precompute goal distributions for round xG profiles and the teams in a shots file",
+    )
+    lookup_parser.add_argument(
+        "shots",
+        nargs="?",
+        help="CSV, JSONL or Parquet file of shots, or a shot store directory, whose teams are added to the table",
+    )
+    lookup_parser.add_argument(
+        "--output", "-o", required=True, help="Directory to write the table to"
+    )
+    lookup_parser.add_argument(
+        "--quantum",
+        type=float,
+        default=lookup.DEFAULT_QUANTUM,
+        help="xG values are rounded to multiples of this (use 0.001 or smaller for real shot data)",
+    )
+    lookup_parser.add_argument(
+        "--max-shots",
+        type=int,
+        default=6,
+        help="Largest number of shots in the round xG profiles",
+    )
+    lookup_parser.set_defaults(
+        func=run_lookup,
+        regulation_only=False,
+        exclude_penalties=False,
+        chunksize=100000,
+        batch_size=500,
+    )
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Render the margins graphic of every match in a shots file to image files",
+    )
+    add_shots_arguments(export_parser)
+    export_parser.add_argument(
+        "--output-dir",
+        "-o",
+        required=True,
+        help="Directory to save <match_id>.<format> files to",
+    )
+    export_parser.add_argument(
+        "--formats",
+        nargs="+",
+        choices=export.FORMATS,
+        default=["png"],
+        help="Image formats to write (default: png)",
+    )
+    export_parser.add_argument(
+        "--dpi",
+        type=int,
+        default=export.DEFAULT_DPI,
+        help="Resolution of PNG and WebP files",
+    )
+    export_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of rendering processes (default: one per CPU)",
+    )
+    export_parser.add_argument(
+        "--method",
+        choices=["exact", "simulate"],
+        default="exact",
+        help="Plot exact probabilities or random simulations (default: exact)",
+    )
+    export_parser.add_argument(
+        "--sims",
+        type=int,
+        default=core.N_SIMS,
+        help="Number of simulations per match with --method simulate",
+    )
+    export_parser.add_argument(
+        "--app-url", help="URL shown in the footer of each graphic"
+    )
+    export_parser.set_defaults(func=run_export)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if getattr(args, "lookup_table", None):
+        lookup.install(args.lookup_table)
+
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Measures cold import time and memory of the simulator's modules
+
+Each module is imported in a fresh Python process, so every run pays the full cost a newly started worker would.
+The best wall time over the repeats is kept, along with the process's peak RSS and which heavy dependencies
+the import pulled in. Results can be written to a JSON file and compared between commits.
+
+Examples:
+    python benchmarks/bench_imports.py
+    python benchmarks/bench_imports.py functions.core batch --repeat 10
+    python benchmarks/bench_imports.py --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import pathlib
+import platform
+import subprocess
+import sys
+
+REPOSITORY = pathlib.Path(__file__).resolve().parent.parent
+
+MODULES = [
+    "functions.core",
+    "functions.simulate",
+    "functions.render",
+    "functions.export",
+    "functions.fetch",
+    "functions.xpts",
+    "batch",
+]
+
+HEAVY_DEPENDENCIES = [
+    "pandas",
+    "matplotlib",
+    "seaborn",
+    "highlight_text",
+    "requests",
+    "streamlit",
+]
+
+# run in the child process, printing one JSON line of results
+IMPORT_SCRIPT = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    "dependencies": [name for name in {dependencies!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(module, repeat):
+    """
+    Imports module in repeat fresh interpreters
+    Returns the best wall time in seconds, the peak RSS of that run and the heavy dependencies it loaded,
+    or the error if the module cannot be imported (e.g. it does not exist on an older commit)
+    """
+
+    runs = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                IMPORT_SCRIPT.format(module=module, dependencies=HEAVY_DEPENDENCIES),
+            ],
+            capture_output=True,
+            text=True,
+            cwd=REPOSITORY,
+        )
+        if completed.returncode != 0:
+            return {
+                "module": module,
+                "error": completed.stderr.strip().splitlines()[-1],
+            }
+
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    best = min(runs, key=lambda run: run["seconds"])
+
+    return {"module": module, **best}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=REPOSITORY,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_seconds = {}
+    if baseline:
+        baseline_seconds = {
+            result["module"]: result["seconds"]
+            for result in baseline["results"]
+            if "error" not in result
+        }
+
+    print(
+        f"{'module':<22}{'seconds':>10}{'RSS MB':>10}"
+        + (f"{'vs base':>10}" if baseline else "")
+        + "  dependencies"
+    )
+    for result in results:
+        if "error" in result:
+            print(f"{result['module']:<22}  {result['error']}")
+            continue
+
+        line = (
+            f"{result['module']:<22}{result['seconds']:>10.3f}"
+            f"{result['max_rss_bytes'] / 2**20:>10.1f}"
+        )
+        if result["module"] in baseline_seconds:
+            line += f"{result['seconds'] / baseline_seconds[result['module']]:>9.2f}x"
+        print(line + "  " + (", ".join(result["dependencies"]) or "-"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Fresh imports per module (best is kept)"
+    )
+    parser.add_argument(
+        "--output", "-o", help="JSON file to write results to", default=None
+    )
+    parser.add_argument(
+        "--compare", help="JSON file from a previous run to compare timings against"
+    )
+    args = parser.parse_args(argv)
+
+    results = [measure_import(module, args.repeat) for module in args.modules]
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
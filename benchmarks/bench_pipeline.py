@@ -0,0 +1,256 @@
+"""
+Benchmarks each stage of the simulation, aggregation and plotting pipeline
+
+Times every stage for a grid of shots per team and numbers of simulations, records peak traced memory,
+and writes the results to a JSON file so runs on different commits can be compared.
+
+Examples:
+    python benchmarks/bench_pipeline.py --output bench.json
+    python benchmarks/bench_pipeline.py --sims 10000 100000 --shots 20 --engines exact simulate
+    python benchmarks/bench_pipeline.py --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# allow running as a script from the repository root or the benchmarks directory
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import matplotlib as mpl
+
+mpl.use("Agg")
+
+import numpy as np
+
+from functions import render, simulate
+
+ENGINES = ["simulate", "parallel", "exact"]
+
+
+def make_xg(number_of_shots, seed):
+    """
+    Returns a realistic looking list of shot xG values, mostly low quality chances with the odd big chance
+    """
+
+    xg_rng = np.random.default_rng(seed)
+    return np.clip(xg_rng.beta(0.6, 6, number_of_shots), 0.01, 0.95).round(3).tolist()
+
+
+def measure(function, repeat):
+    """
+    Runs function repeat times and once more under tracemalloc
+    Returns the best wall time in seconds, the peak traced memory in bytes and the function's result
+    """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak_memory, result
+
+
+def bench_case(engine, number_of_shots, number_of_sims, repeat, plots):
+    home_xg = make_xg(number_of_shots, seed=1)
+    away_xg = make_xg(number_of_shots, seed=2)
+
+    stages = {}
+
+    if engine == "exact":
+        stages["exact"] = lambda: simulate.get_exact_match_outcomes(home_xg, away_xg)
+    else:
+        workers = os.cpu_count() if engine == "parallel" else 1
+
+        def simulate_uncached():
+            simulate.match_outcomes_cache.clear()
+            return simulate.simulate_match(
+                home_xg, away_xg, number_of_sims, workers=workers
+            )
+
+        stages["simulate_match"] = simulate_uncached
+
+        if engine == "simulate":
+            sim_rng = np.random.default_rng(simulate.SEED)
+            home_goals = simulate.simulate_chances(sim_rng, number_of_sims, home_xg)
+            away_goals = simulate.simulate_chances(sim_rng, number_of_sims, away_xg)
+
+            stages["simulate_chances"] = lambda: simulate.simulate_chances(
+                np.random.default_rng(simulate.SEED), number_of_sims, home_xg
+            )
+            stages["get_match_outcomes"] = lambda: simulate.get_match_outcomes(
+                home_goals, away_goals
+            )
+
+    results = []
+    match_outcomes = None
+
+    def record(stage, function):
+        seconds, peak_memory, result = measure(function, repeat)
+        results.append(
+            {
+                "engine": engine,
+                "shots": number_of_shots,
+                "sims": None if engine == "exact" else number_of_sims,
+                "stage": stage,
+                "seconds": seconds,
+                "peak_memory_bytes": peak_memory,
+            }
+        )
+        return result
+
+    for stage, function in stages.items():
+        match_outcomes = record(stage, function)
+
+    record(
+        "get_sims_matching_score",
+        lambda: simulate.get_sims_matching_score(match_outcomes, 1, 1),
+    )
+
+    if plots:
+        (
+            simulated_home_win_percent,
+            simulated_away_win_percent,
+            simulated_draw_percent,
+            percentage_of_sims_matching_actual_score,
+        ) = simulate.get_sims_matching_score(match_outcomes, 1, 1)
+
+        def plot_margins():
+            render.figure_cache.clear()
+            return render.render_margins(
+                match_outcomes,
+                1,
+                1,
+                simulated_home_win_percent,
+                simulated_draw_percent,
+                simulated_away_win_percent,
+                percentage_of_sims_matching_actual_score,
+                sum(home_xg),
+                sum(away_xg),
+                app_url="",
+            )
+
+        def plot_exact_scores():
+            render.figure_cache.clear()
+            return render.render_exact_scores(match_outcomes)
+
+        record("plot_margins", plot_margins)
+        record("plot_exact_scores", plot_exact_scores)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=pathlib.Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return (result["engine"], result["shots"], result["sims"], result["stage"])
+
+
+def print_results(results, baseline=None):
+    baseline_seconds = {}
+    if baseline:
+        baseline_seconds = {
+            case_key(result): result["seconds"] for result in baseline["results"]
+        }
+
+    print(
+        f"{'engine':<10}{'shots':>6}{'sims':>10}  {'stage':<26}{'seconds':>10}{'peak MB':>10}"
+        + (f"{'vs base':>10}" if baseline else "")
+    )
+    for result in results:
+        line = (
+            f"{result['engine']:<10}{result['shots']:>6}{result['sims'] or '-':>10}  "
+            f"{result['stage']:<26}{result['seconds']:>10.4f}"
+            f"{result['peak_memory_bytes'] / 2**20:>10.2f}"
+        )
+        if case_key(result) in baseline_seconds:
+            line += f"{result['seconds'] / baseline_seconds[case_key(result)]:>9.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shots", type=int, nargs="+", default=[5, 20, 40])
+    parser.add_argument(
+        "--sims", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000]
+    )
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Timed runs per stage (best is kept)"
+    )
+    parser.add_argument(
+        "--no-plots", action="store_true", help="Skip the plotting stages"
+    )
+    parser.add_argument(
+        "--output", "-o", help="JSON file to write results to", default=None
+    )
+    parser.add_argument(
+        "--compare", help="JSON file from a previous run to compare timings against"
+    )
+    args = parser.parse_args(argv)
+
+    # match the resolution the app renders at
+    mpl.rcParams["figure.dpi"] = 300
+
+    results = []
+    for engine in args.engines:
+        # exact probabilities do not depend on the number of simulations
+        sims_grid = args.sims[:1] if engine == "exact" else args.sims
+        for number_of_shots in args.shots:
+            for number_of_sims in sims_grid:
+                results.extend(
+                    bench_case(
+                        engine,
+                        number_of_shots,
+                        number_of_sims,
+                        args.repeat,
+                        not args.no_plots,
+                    )
+                )
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
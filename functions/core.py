@@ -0,0 +1,1128 @@
+"""
+Dependency-light core of the simulator: parsing, simulation, exact probabilities and aggregation
+
+Only NumPy (and the standard library) is imported, so headless batch jobs and API workers can use this module
+without paying for pandas, matplotlib or seaborn. functions.simulate re-exports everything here alongside the plots.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import statistics
+
+import numpy as np
+
+from functions import cache, metrics
+
+# the names functions.simulate re-exports. Settings that are changed at runtime (CHUNK_SIZE, XG_DECIMALS,
+# BIT_GENERATOR and lookup_table) are left out, because a star import would copy their values rather than
+# share them, so they must be read and set on this module, e.g. via lookup.install
+__all__ = [
+    "N_SIMS",
+    "SEED",
+    "OUTCOME_LABELS",
+    "match_outcomes_cache",
+    "BIT_GENERATORS",
+    "EXECUTORS",
+    "POPCOUNT",
+    "PERTURBATIONS",
+    "group_chances",
+    "simulate_chances",
+    "get_goals_dtype",
+    "StringRepresentsFloat",
+    "xg_to_array",
+    "get_match_outcomes",
+    "canonical_xg",
+    "get_seed_sequence",
+    "get_generator",
+    "get_team_generators",
+    "iter_simulation_batches",
+    "simulate_score_counts",
+    "get_simulation_key",
+    "simulate_match",
+    "iter_simulate_match",
+    "simulate_variants",
+    "simulate_shot_outcomes",
+    "count_packed",
+    "get_shot_attribution",
+    "get_standard_errors",
+    "simulate_match_adaptive",
+    "get_goal_distributions",
+    "calculate_goal_distributions",
+    "calculate_padded_goal_distributions",
+    "get_goal_distribution",
+    "get_match_probabilities",
+    "get_prefix_goal_distributions",
+    "get_suffix_goal_distributions",
+    "get_timeline",
+    "perturb_xg",
+    "sweep_xg_uncertainty",
+    "get_sweep_bands",
+    "get_exact_match_outcomes",
+    "get_score_matrix",
+    "get_outcome_probabilities",
+    "get_margin_distribution",
+    "get_score_probability",
+    "get_sims_matching_score",
+    "get_outcome_codes",
+]
+
+N_SIMS = 100000
+SEED = 0
+
+# upper bound on the number of random draws (and of simulations being counted) held in memory at once
+CHUNK_SIZE = 2**15
+
+# xG values are rounded to this many decimal places before being used as a cache key
+XG_DECIMALS = 6
+
+# outcome codes are the sign of the home margin plus one, indexing these labels
+OUTCOME_LABELS = ["Away win", "Draw", "Home win"]
+
+match_outcomes_cache = cache.LRUCache(maxsize=256)
+
+# precomputed goal distributions used by get_goal_distributions when set, see lookup.install
+lookup_table = None
+
+# bit generators that can drive the simulations, chosen with the XG_SIMULATOR_BIT_GENERATOR environment variable
+BIT_GENERATORS = {
+    "PCG64": np.random.PCG64,
+    "PCG64DXSM": np.random.PCG64DXSM,
+    "Philox": np.random.Philox,
+    "SFC64": np.random.SFC64,
+}
+BIT_GENERATOR = os.environ.get("XG_SIMULATOR_BIT_GENERATOR", "PCG64")
+
+EXECUTORS = {
+    "process": concurrent.futures.ProcessPoolExecutor,
+    "thread": concurrent.futures.ThreadPoolExecutor,
+}
+
+
+def group_chances(xg_of_shots, groups):
+    """
+    Combines shots sharing a group ID (e.g. a shot and its rebound, or shots from the same possession) into one chance
+    Each chance scores with probability 1 - prod(1 - xG) over its shots, so a group produces at most one goal
+    Returns an array with the xG of each chance, in order of each group's first shot
+    """
+
+    xg_of_shots = np.asarray(xg_of_shots, dtype=float)
+    groups = np.asarray(groups)
+
+    if len(xg_of_shots) == 0:
+        return xg_of_shots
+
+    _, first_shots, group_codes = np.unique(
+        groups, return_index=True, return_inverse=True
+    )
+
+    # the product of misses is a sum of logs, so every group is reduced in one bincount
+    with np.errstate(divide="ignore"):
+        log_miss_probabilities = np.bincount(
+            group_codes.ravel(), weights=np.log1p(-xg_of_shots)
+        )
+
+    xg_of_chances = -np.expm1(log_miss_probabilities)
+
+    return xg_of_chances[np.argsort(first_shots)]
+
+
+def simulate_chances(rng, number_of_sims, xg_of_chances, groups=None):
+    """
+    Simulates goals scored given a list of xG chances
+    Returns a 1D array of size number_of_sims with each element being the goals scored in that simulation,
+    using the smallest unsigned integer dtype that can hold the number of chances (uint8 for up to 255)
+    If groups is given, shots sharing a group ID are combined with group_chances and score at most one goal between them
+
+    Draws are made as a (simulations x shots) matrix in blocks of at most CHUNK_SIZE values,
+    so results only depend on the generator state and not on the block size used
+    """
+
+    if groups is not None:
+        xg_of_chances = group_chances(xg_of_chances, groups)
+
+    xg_of_chances = np.asarray(xg_of_chances, dtype=float)
+    number_of_shots = len(xg_of_chances)
+
+    goals_scored = np.zeros(number_of_sims, dtype=get_goals_dtype(number_of_shots))
+
+    if number_of_shots == 0:
+        return goals_scored
+
+    sims_per_chunk = max(1, CHUNK_SIZE // number_of_shots)
+
+    for start in range(0, number_of_sims, sims_per_chunk):
+        stop = min(start + sims_per_chunk, number_of_sims)
+        random = rng.random((stop - start, number_of_shots))
+        goals_scored[start:stop] = np.count_nonzero(random <= xg_of_chances, axis=1)
+
+    return goals_scored
+
+
+def get_goals_dtype(number_of_shots):
+    """
+    Returns the smallest unsigned integer dtype that can count goals from number_of_shots chances
+    """
+
+    return np.min_scalar_type(number_of_shots)
+
+
+def StringRepresentsFloat(s):
+    try:
+        float(s)
+        return str(float(s)) == s
+    except ValueError:
+        return False
+
+
+@metrics.instrument("parsing")
+def xg_to_array(xg_string, return_groups=False):
+    """
+    Parses comma separated xG values, where shots joined with a '+' (e.g. "0.4+0.3, 0.2") are one chance
+    If return_groups is True, also returns a group ID for each shot, shared by shots in the same chance
+    """
+
+    xg_array = []
+    groups = []
+
+    for group, chance in enumerate(xg_string.split(",")):
+        trimmed_array = [x.strip() for x in chance.split("+")]
+        # handle case where extra trailing comma is included
+        for trimmed_x in trimmed_array:
+            if StringRepresentsFloat(trimmed_x) and 0 < float(trimmed_x) < 1:
+                xg_array.append(float(trimmed_x))
+                groups.append(group)
+
+    if return_groups:
+        return xg_array, groups
+
+    return xg_array
+
+
+@metrics.instrument("aggregation")
+def get_match_outcomes(home_goals, away_goals, shape=None):
+    """
+    Counts how many simulations ended in each scoreline
+    Returns a 2D array where element [i, j] is the number of simulations with the home team scoring i and the away team scoring j
+    If shape is not given, the table is just large enough to hold the highest simulated scores
+    Goals can be any integer dtype, and are widened for indexing in blocks of CHUNK_SIZE simulations
+    """
+
+    home_goals = np.asarray(home_goals)
+    away_goals = np.asarray(away_goals)
+
+    if shape is None:
+        shape = (int(home_goals.max(initial=0)) + 1, int(away_goals.max(initial=0)) + 1)
+
+    number_of_home_scores, number_of_away_scores = shape
+
+    score_counts = np.zeros(
+        number_of_home_scores * number_of_away_scores, dtype=np.int64
+    )
+
+    for start in range(0, len(home_goals), CHUNK_SIZE):
+        scores = home_goals[start : start + CHUNK_SIZE].astype(np.intp)
+        scores *= number_of_away_scores
+        scores += away_goals[start : start + CHUNK_SIZE]
+
+        score_counts += np.bincount(scores, minlength=len(score_counts))
+
+    return score_counts.reshape(number_of_home_scores, number_of_away_scores)
+
+
+def canonical_xg(xg_of_chances):
+    """
+    Returns a list of xG chances as a sorted tuple of rounded floats, so equivalent shot lists share a cache key
+    """
+
+    return tuple(
+        sorted(round(float(shot_xg), XG_DECIMALS) for shot_xg in xg_of_chances)
+    )
+
+
+def get_seed_sequence(seed, *inputs):
+    """
+    Returns a SeedSequence keyed on seed and the inputs being simulated, so every distinct input gets its own
+    stream and identical inputs always get the same one. A SeedSequence seed is returned unchanged
+    Inputs are identified by their repr, so they should be canonical (e.g. from canonical_xg) or bytes
+    """
+
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+
+    digest = hashlib.blake2b(repr(inputs).encode(), digest_size=16).digest()
+
+    return np.random.SeedSequence(
+        [seed, *np.frombuffer(digest, dtype=np.uint32).tolist()]
+    )
+
+
+def get_generator(seed):
+    """
+    Returns a new generator from the configured BIT_GENERATOR seeded with seed (an int or a SeedSequence)
+    """
+
+    if BIT_GENERATOR not in BIT_GENERATORS:
+        raise ValueError(
+            f"bit generator must be one of {sorted(BIT_GENERATORS)}, not {BIT_GENERATOR!r}"
+        )
+
+    return np.random.Generator(BIT_GENERATORS[BIT_GENERATOR](seed))
+
+
+def get_team_generators(seed):
+    """
+    Returns independent home and away generators derived from seed (an int or a SeedSequence)
+    Giving each team its own stream means simulating in batches draws exactly the same shots as one large run
+    """
+
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    home_seed, away_seed = seed.spawn(2)
+
+    return get_generator(home_seed), get_generator(away_seed)
+
+
+def iter_simulation_batches(
+    home_xg, away_xg, batch_size=10000, seed=SEED, max_sims=None
+):
+    """
+    Simulates a match in batches of batch_size simulations, stopping after max_sims if given
+    Yields the cumulative scoreline counts and number of simulations after each batch
+    Counts are sized to hold every possible score, and the same counts array is updated in place between batches
+    An int seed is keyed on the shots with get_seed_sequence, so results only depend on the inputs
+    """
+
+    home_xg = canonical_xg(home_xg)
+    away_xg = canonical_xg(away_xg)
+
+    home_rng, away_rng = get_team_generators(get_seed_sequence(seed, home_xg, away_xg))
+    shape = (len(home_xg) + 1, len(away_xg) + 1)
+
+    score_counts = np.zeros(shape, dtype=np.int64)
+    number_of_sims = 0
+
+    while max_sims is None or number_of_sims < max_sims:
+        if max_sims is None:
+            sims_in_batch = batch_size
+        else:
+            sims_in_batch = min(batch_size, max_sims - number_of_sims)
+
+        home_goals = simulate_chances(home_rng, sims_in_batch, home_xg)
+        away_goals = simulate_chances(away_rng, sims_in_batch, away_xg)
+
+        score_counts += get_match_outcomes(home_goals, away_goals, shape=shape)
+        number_of_sims += sims_in_batch
+
+        yield score_counts, number_of_sims
+
+
+def simulate_score_counts(seed, number_of_sims, home_xg, away_xg):
+    """
+    Simulates both teams from generators derived from seed (an int or a SeedSequence)
+    Returns scoreline counts sized to hold every possible score, so counts from separate runs can be added together
+    """
+
+    score_counts = np.zeros((len(home_xg) + 1, len(away_xg) + 1), dtype=np.int64)
+
+    # batches only bound memory use, as each team's draws do not depend on the batch size
+    for score_counts, _ in iter_simulation_batches(
+        home_xg, away_xg, CHUNK_SIZE, seed, number_of_sims
+    ):
+        pass
+
+    return score_counts
+
+
+def get_simulation_key(home_xg, away_xg, number_of_sims, seed, workers=1):
+    return (
+        canonical_xg(home_xg),
+        canonical_xg(away_xg),
+        number_of_sims,
+        seed,
+        workers,
+        BIT_GENERATOR,
+    )
+
+
+@metrics.instrument("simulation")
+def simulate_match(
+    home_xg, away_xg, number_of_sims=N_SIMS, seed=SEED, workers=1, backend="process"
+):
+    """
+    Simulates a match and returns the scoreline counts from get_match_outcomes
+    With more than one worker, simulations are split into one chunk per worker, each drawn from an independent child of
+    the match's get_seed_sequence, on a "process" or "thread" pool. Results are reproducible for a given seed and number of workers
+    Results are cached on the canonical shot lists, number of simulations, seed and workers, so identical matches are only simulated once
+    """
+
+    if backend not in EXECUTORS:
+        raise ValueError(f"backend must be one of {sorted(EXECUTORS)}, not {backend!r}")
+
+    key = get_simulation_key(home_xg, away_xg, number_of_sims, seed, workers)
+    home_xg, away_xg = key[:2]
+
+    def run_simulation():
+        if workers == 1:
+            match_outcomes = simulate_score_counts(
+                seed, number_of_sims, home_xg, away_xg
+            )
+        else:
+            chunk_seeds = get_seed_sequence(seed, home_xg, away_xg).spawn(workers)
+            chunk_sizes = [
+                number_of_sims // workers + (i < number_of_sims % workers)
+                for i in range(workers)
+            ]
+
+            with EXECUTORS[backend](max_workers=workers) as executor:
+                chunk_outcomes = executor.map(
+                    simulate_score_counts,
+                    chunk_seeds,
+                    chunk_sizes,
+                    [home_xg] * workers,
+                    [away_xg] * workers,
+                )
+                match_outcomes = sum(chunk_outcomes)
+
+        # cached results are shared between callers, so guard against in-place changes
+        match_outcomes.flags.writeable = False
+
+        return match_outcomes
+
+    return match_outcomes_cache.get_or_compute(key, run_simulation)
+
+
+def iter_simulate_match(
+    home_xg, away_xg, number_of_sims=N_SIMS, seed=SEED, batch_size=10000
+):
+    """
+    Simulates a match like simulate_match, yielding the running scoreline counts and number of simulations after each batch
+    The final counts are identical to simulate_match's and are added to its cache. A cached match is yielded once, complete
+    """
+
+    key = get_simulation_key(home_xg, away_xg, number_of_sims, seed)
+
+    match_outcomes = match_outcomes_cache.get(key)
+    if match_outcomes is not None:
+        yield match_outcomes, number_of_sims
+        return
+
+    for score_counts, sims_so_far in iter_simulation_batches(
+        home_xg, away_xg, batch_size, seed, number_of_sims
+    ):
+        yield score_counts, sims_so_far
+
+    score_counts.flags.writeable = False
+    match_outcomes_cache.put(key, score_counts)
+
+
+@metrics.instrument("simulation")
+def simulate_variants(xg_of_shots, is_home, masks, number_of_sims=N_SIMS, seed=SEED):
+    """
+    Simulates several variants of a match from one shared set of simulated shot outcomes
+    Each row of masks selects the shots counted in a variant (see filters.get_masks) and is_home marks the home team's shots
+    Every variant sees the same outcome for each shot, so differences between variants are not sampling noise
+    Returns a list of scoreline counts, one per variant, each sized to hold every possible score in that variant
+    """
+
+    xg_of_shots = np.asarray(xg_of_shots, dtype=float)
+    is_home = np.asarray(is_home, dtype=bool)
+    masks = np.asarray(masks, dtype=bool).reshape(-1, len(xg_of_shots))
+
+    key = (
+        "variants",
+        # plain floats and bytes, whose reprs (unlike NumPy scalars') do not depend on the NumPy version
+        tuple(np.round(xg_of_shots, XG_DECIMALS).tolist()),
+        is_home.tobytes(),
+        masks.tobytes(),
+        masks.shape,
+        number_of_sims,
+        seed,
+        BIT_GENERATOR,
+    )
+
+    def run_simulation():
+        variant_rng = get_generator(get_seed_sequence(seed, "variants", *key[1:3]))
+
+        # goals for every variant are matrix products of the simulated shot outcomes with these selections
+        home_shots = (masks & is_home).astype(np.float32).T
+        away_shots = (masks & ~is_home).astype(np.float32).T
+
+        shapes = [
+            (home_count + 1, away_count + 1)
+            for home_count, away_count in zip(
+                home_shots.sum(axis=0).astype(int), away_shots.sum(axis=0).astype(int)
+            )
+        ]
+        variant_outcomes = [np.zeros(shape, dtype=np.int64) for shape in shapes]
+        goals_dtype = get_goals_dtype(len(xg_of_shots))
+
+        sims_per_chunk = max(1, CHUNK_SIZE // max(len(xg_of_shots), 1))
+
+        for start in range(0, number_of_sims, sims_per_chunk):
+            stop = min(start + sims_per_chunk, number_of_sims)
+            scored = (
+                variant_rng.random((stop - start, len(xg_of_shots))) <= xg_of_shots
+            ).astype(np.float32)
+
+            # the products hold whole numbers of goals, so they are stored as compact integers
+            home_goals = (scored @ home_shots).astype(goals_dtype)
+            away_goals = (scored @ away_shots).astype(goals_dtype)
+
+            for variant, shape in enumerate(shapes):
+                variant_outcomes[variant] += get_match_outcomes(
+                    home_goals[:, variant], away_goals[:, variant], shape=shape
+                )
+
+        for match_outcomes in variant_outcomes:
+            match_outcomes.flags.writeable = False
+
+        return variant_outcomes
+
+    return match_outcomes_cache.get_or_compute(key, run_simulation)
+
+
+# number of set bits in each possible byte, for counting bit-packed outcomes
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def simulate_shot_outcomes(xg_of_shots, number_of_sims=N_SIMS, seed=SEED):
+    """
+    Simulates whether each shot scored, keeping every outcome rather than just the goals per team
+    Returns a (ceil(number_of_sims / 8) x shots) uint8 array of outcomes bit-packed along the simulations (see np.packbits),
+    so bit k of column s is whether shot s scored in simulation k. Padding bits in the last row are zero
+    """
+
+    xg_of_shots = np.asarray(xg_of_shots, dtype=float)
+    number_of_shots = len(xg_of_shots)
+
+    shot_rng = get_generator(
+        get_seed_sequence(
+            seed, "shots", tuple(np.round(xg_of_shots, XG_DECIMALS).tolist())
+        )
+    )
+
+    packed_outcomes = np.zeros(((number_of_sims + 7) // 8, number_of_shots), np.uint8)
+
+    # chunks hold a whole number of bytes of simulations
+    sims_per_chunk = max(8, CHUNK_SIZE // max(number_of_shots, 1) // 8 * 8)
+
+    for start in range(0, number_of_sims, sims_per_chunk):
+        stop = min(start + sims_per_chunk, number_of_sims)
+        scored = shot_rng.random((stop - start, number_of_shots)) <= xg_of_shots
+        packed_outcomes[start // 8 : (stop + 7) // 8] = np.packbits(scored, axis=0)
+
+    return packed_outcomes
+
+
+def count_packed(packed_outcomes):
+    """
+    Returns the number of set bits in each column of a bit-packed outcome array
+    """
+
+    return POPCOUNT[packed_outcomes].sum(axis=0, dtype=np.int64)
+
+
+@metrics.instrument("attribution")
+def get_shot_attribution(
+    xg_of_shots, is_home, players, number_of_sims=N_SIMS, seed=SEED
+):
+    """
+    Attributes a match's outcome to its shots and players from one simulation of every shot's outcome
+    Returns a dict of arrays with one element per shot:
+        goal_probability: the proportion of simulations in which the shot scored
+        win_probability_added: how much lower its team's win probability would be without the shot, which is the
+            proportion of simulations in which the shot scored and its team won by exactly one goal
+    and, for the unique players in sorted order (under "players"):
+        player_xg, player_goals (mean simulated goals) and player_scored_probability (of scoring at least once)
+    along with the match's home_win, draw and away_win proportions
+    Every figure comes from the same simulations, instead of re-running the match once with each shot removed
+    """
+
+    xg_of_shots = np.asarray(xg_of_shots, dtype=float)
+    is_home = np.asarray(is_home, dtype=bool)
+    players = np.asarray(players)
+
+    key = (
+        "attribution",
+        tuple(np.round(xg_of_shots, XG_DECIMALS)),
+        tuple(is_home),
+        tuple(players.tolist()),
+        number_of_sims,
+        seed,
+        BIT_GENERATOR,
+    )
+
+    def run_attribution():
+        packed_outcomes = simulate_shot_outcomes(xg_of_shots, number_of_sims, seed)
+
+        home_goals = np.zeros(number_of_sims, dtype=get_goals_dtype(len(xg_of_shots)))
+        away_goals = np.zeros_like(home_goals)
+
+        bytes_per_chunk = max(1, CHUNK_SIZE // max(len(xg_of_shots), 1) // 8)
+        for start in range(0, len(packed_outcomes), bytes_per_chunk):
+            scored = np.unpackbits(
+                packed_outcomes[start : start + bytes_per_chunk], axis=0
+            )[: number_of_sims - 8 * start]
+            sims = slice(8 * start, 8 * start + len(scored))
+            home_goals[sims] = np.count_nonzero(scored[:, is_home], axis=1)
+            away_goals[sims] = np.count_nonzero(scored[:, ~is_home], axis=1)
+
+        home_margin = home_goals.astype(np.int16) - away_goals
+
+        # a goal only changes a win into a draw when its team won by exactly one
+        won_by_one = np.where(
+            is_home,
+            np.packbits(home_margin == 1)[:, None],
+            np.packbits(home_margin == -1)[:, None],
+        )
+
+        goal_probability = count_packed(packed_outcomes) / number_of_sims
+        win_probability_added = (
+            count_packed(packed_outcomes & won_by_one) / number_of_sims
+        )
+
+        unique_players, player_codes = np.unique(players, return_inverse=True)
+        player_codes = player_codes.ravel()
+
+        # a player scored at least once wherever any of their shots' bits is set
+        player_scored = np.zeros((len(packed_outcomes), len(unique_players)), np.uint8)
+        for k in range(len(unique_players)):
+            player_scored[:, k] = np.bitwise_or.reduce(
+                packed_outcomes[:, player_codes == k], axis=1
+            )
+
+        return {
+            "goal_probability": goal_probability,
+            "win_probability_added": win_probability_added,
+            "players": unique_players,
+            "player_xg": np.bincount(
+                player_codes, weights=xg_of_shots, minlength=len(unique_players)
+            ),
+            "player_goals": np.bincount(
+                player_codes, weights=goal_probability, minlength=len(unique_players)
+            ),
+            "player_scored_probability": count_packed(player_scored) / number_of_sims,
+            "home_win": np.count_nonzero(home_margin > 0) / number_of_sims,
+            "draw": np.count_nonzero(home_margin == 0) / number_of_sims,
+            "away_win": np.count_nonzero(home_margin < 0) / number_of_sims,
+        }
+
+    return match_outcomes_cache.get_or_compute(key, run_attribution)
+
+
+def get_standard_errors(score_matrix, home_goals, away_goals):
+    """
+    Returns the standard errors of the home win, draw, away win and exact score proportions of simulated scoreline counts
+    """
+
+    number_of_sims = score_matrix.sum()
+
+    home_win, draw, away_win = get_outcome_probabilities(score_matrix)
+    actual_score = get_score_probability(score_matrix, home_goals, away_goals)
+
+    return {
+        outcome: np.sqrt(proportion * (1 - proportion) / number_of_sims)
+        for outcome, proportion in [
+            ("home_win", home_win),
+            ("draw", draw),
+            ("away_win", away_win),
+            ("actual_score", actual_score),
+        ]
+    }
+
+
+def simulate_match_adaptive(
+    home_xg,
+    away_xg,
+    home_goals,
+    away_goals,
+    interval_width=0.01,
+    confidence=0.95,
+    batch_size=10000,
+    max_sims=100 * N_SIMS,
+    seed=SEED,
+):
+    """
+    Simulates a match in batches until the confidence intervals of the home win, draw, away win and
+    actual score (home_goals - away_goals) proportions are all no wider than interval_width, or max_sims is reached
+    Returns the scoreline counts, the standard errors from get_standard_errors and the number of simulations used
+    """
+
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+    key = (
+        "adaptive",
+        canonical_xg(home_xg),
+        canonical_xg(away_xg),
+        home_goals,
+        away_goals,
+        interval_width,
+        confidence,
+        batch_size,
+        max_sims,
+        seed,
+        BIT_GENERATOR,
+    )
+
+    def run_simulation():
+        for score_counts, number_of_sims in iter_simulation_batches(
+            home_xg, away_xg, batch_size, seed, max_sims
+        ):
+            standard_errors = get_standard_errors(score_counts, home_goals, away_goals)
+            if 2 * z * max(standard_errors.values()) <= interval_width:
+                break
+
+        score_counts.flags.writeable = False
+
+        return score_counts, standard_errors, number_of_sims
+
+    return match_outcomes_cache.get_or_compute(key, run_simulation)
+
+
+def get_goal_distributions(xg_lists):
+    """
+    Calculates the exact distribution of goals scored for many lists of xG chances at once
+    Returns a 2D array where element [k, i] is the probability of xg_lists[k] producing exactly i goals,
+    padded with zeros up to the length of the longest list
+    Lists found in lookup_table are copied from it rather than calculated
+    """
+
+    max_shots = max((len(xg_of_chances) for xg_of_chances in xg_lists), default=0)
+
+    goal_distributions = np.zeros((len(xg_lists), max_shots + 1))
+
+    calculate = list(range(len(xg_lists)))
+    if lookup_table is not None:
+        calculate = []
+        for k, xg_of_chances in enumerate(xg_lists):
+            goal_distribution = lookup_table.get(xg_of_chances)
+            if goal_distribution is None:
+                calculate.append(k)
+            else:
+                goal_distributions[k, : len(goal_distribution)] = goal_distribution
+
+        if not calculate:
+            return goal_distributions
+
+        max_shots = max(len(xg_lists[k]) for k in calculate)
+
+    goal_distributions[calculate, : max_shots + 1] = calculate_goal_distributions(
+        [xg_lists[k] for k in calculate], max_shots
+    )
+
+    return goal_distributions
+
+
+def calculate_goal_distributions(xg_lists, max_shots):
+    """
+    Calculates get_goal_distributions by dynamic programming over the shots, padded to max_shots + 1 goals
+    """
+
+    # padding with zero xG chances leaves each distribution unchanged
+    xg = np.zeros((len(xg_lists), max_shots))
+    for k, xg_of_chances in enumerate(xg_lists):
+        xg[k, : len(xg_of_chances)] = xg_of_chances
+
+    return calculate_padded_goal_distributions(xg)
+
+
+def calculate_padded_goal_distributions(xg):
+    """
+    Calculates the goal distribution of every row of a 2D array of xG chances, padded with zero xG chances,
+    in one dynamic programme over the columns
+    Returns a 2D array where element [k, i] is the probability of row k producing exactly i goals
+    """
+
+    number_of_lists, max_shots = xg.shape
+
+    goal_distributions = np.zeros((number_of_lists, max_shots + 1))
+    goal_distributions[:, 0] = 1
+
+    for i in range(max_shots):
+        shot_xg = xg[:, i : i + 1]
+        # each shot either misses (goals unchanged) or scores (goals shift up by one)
+        goal_distributions[:, 1 : i + 2] = (
+            goal_distributions[:, 1 : i + 2] * (1 - shot_xg)
+            + goal_distributions[:, : i + 1] * shot_xg
+        )
+        goal_distributions[:, 0] = goal_distributions[:, 0] * (1 - shot_xg[:, 0])
+
+    return goal_distributions
+
+
+def get_goal_distribution(xg_of_chances):
+    """
+    Calculates the exact distribution of goals scored given a list of xG chances
+    Returns a 1D array where element i is the probability of scoring exactly i goals
+    """
+
+    if lookup_table is not None:
+        goal_distribution = lookup_table.get(xg_of_chances)
+        if goal_distribution is not None:
+            return goal_distribution
+
+    return get_goal_distributions([xg_of_chances])[0]
+
+
+def get_match_probabilities(home_goal_distributions, away_goal_distributions):
+    """
+    Calculates exact home win, draw and away win probabilities for many matches at once from get_goal_distributions output
+    Returns three 1D arrays with one element per match
+    """
+
+    width = max(home_goal_distributions.shape[1], away_goal_distributions.shape[1])
+
+    home = np.pad(
+        home_goal_distributions, ((0, 0), (0, width - home_goal_distributions.shape[1]))
+    )
+    away = np.pad(
+        away_goal_distributions, ((0, 0), (0, width - away_goal_distributions.shape[1]))
+    )
+
+    # the home team wins when it scores i goals and the away team scores fewer than i, and vice versa
+    # (summed directly rather than as 1 - home_win - draw, which can round to a tiny negative)
+    away_fewer = np.cumsum(away, axis=1)[:, :-1]
+    home_fewer = np.cumsum(home, axis=1)[:, :-1]
+    home_win = (home[:, 1:] * away_fewer).sum(axis=1)
+    draw = (home * away).sum(axis=1)
+    away_win = (away[:, 1:] * home_fewer).sum(axis=1)
+
+    return home_win, draw, away_win
+
+
+def get_prefix_goal_distributions(xg_of_chances):
+    """
+    Calculates the goal distribution after each chance in turn by adding one chance at a time
+    Returns a 2D array where element [k, i] is the probability of the first k chances producing exactly i goals
+    """
+
+    number_of_chances = len(xg_of_chances)
+
+    goal_distributions = np.zeros((number_of_chances + 1, number_of_chances + 1))
+    goal_distributions[0, 0] = 1
+
+    for k, shot_xg in enumerate(xg_of_chances):
+        # each chance either misses (goals unchanged) or scores (goals shift up by one)
+        goal_distributions[k + 1] = goal_distributions[k] * (1 - shot_xg)
+        goal_distributions[k + 1, 1:] += goal_distributions[k, :-1] * shot_xg
+
+    return goal_distributions
+
+
+def get_suffix_goal_distributions(xg_of_chances, goals_so_far):
+    """
+    Calculates the final goal distribution after each chance in turn, given goals_so_far[k] goals from the first k chances
+    and the remaining chances still to come
+    Returns a 2D array where element [k, i] is the probability of finishing with exactly i goals
+    """
+
+    number_of_chances = len(xg_of_chances)
+
+    # the distribution of the last j chances is row j of the prefix distributions of the reversed chances
+    remaining = get_prefix_goal_distributions(list(xg_of_chances)[::-1])[::-1]
+
+    goal_distributions = np.zeros((number_of_chances + 1, number_of_chances + 1))
+    for k, goals in enumerate(goals_so_far):
+        goal_distributions[k, goals:] = remaining[k, : number_of_chances + 1 - goals]
+
+    return goal_distributions
+
+
+@metrics.instrument("timeline")
+def get_timeline(
+    home_xg, home_minutes, away_xg, away_minutes, home_scored=None, away_scored=None
+):
+    """
+    Calculates how a match's probabilities develop over time, at kick off and at each minute with a shot
+    Returns a dict of arrays with one element per minute:
+        minute, and the probabilities of home_leading, level and away_leading from the chances taken so far
+    If home_scored and away_scored (which shots were goals) are given, also includes home_goals and away_goals
+    (the actual score so far) and home_win, draw and away_win: the final outcome probabilities given the actual score
+    so far and the chances still to come
+    Each distribution adds one chance to the previous one, rather than recalculating the match for every minute
+    """
+
+    home_order = np.argsort(home_minutes, kind="stable")
+    away_order = np.argsort(away_minutes, kind="stable")
+
+    home_xg = np.asarray(home_xg, dtype=float)[home_order]
+    away_xg = np.asarray(away_xg, dtype=float)[away_order]
+    home_minutes = np.asarray(home_minutes, dtype=int)[home_order]
+    away_minutes = np.asarray(away_minutes, dtype=int)[away_order]
+
+    minutes = np.unique(np.concatenate([[0], home_minutes, away_minutes]))
+
+    # the number of each team's chances taken by the end of each minute
+    home_shots_taken = np.searchsorted(home_minutes, minutes, side="right")
+    away_shots_taken = np.searchsorted(away_minutes, minutes, side="right")
+
+    home_leading, level, away_leading = get_match_probabilities(
+        get_prefix_goal_distributions(home_xg)[home_shots_taken],
+        get_prefix_goal_distributions(away_xg)[away_shots_taken],
+    )
+
+    timeline = {
+        "minute": minutes,
+        "home_leading": home_leading,
+        "level": level,
+        "away_leading": away_leading,
+    }
+
+    if home_scored is not None and away_scored is not None:
+        home_goals_so_far = np.concatenate(
+            [[0], np.cumsum(np.asarray(home_scored, dtype=int)[home_order])]
+        )
+        away_goals_so_far = np.concatenate(
+            [[0], np.cumsum(np.asarray(away_scored, dtype=int)[away_order])]
+        )
+
+        home_win, draw, away_win = get_match_probabilities(
+            get_suffix_goal_distributions(home_xg, home_goals_so_far)[home_shots_taken],
+            get_suffix_goal_distributions(away_xg, away_goals_so_far)[away_shots_taken],
+        )
+
+        timeline.update(
+            {
+                "home_goals": home_goals_so_far[home_shots_taken],
+                "away_goals": away_goals_so_far[away_shots_taken],
+                "home_win": home_win,
+                "draw": draw,
+                "away_win": away_win,
+            }
+        )
+
+    return timeline
+
+
+# ways perturb_xg can model the error in provider xG values
+PERTURBATIONS = ["beta", "calibration"]
+
+
+def perturb_xg(
+    rng,
+    xg_of_chances,
+    number_of_scenarios,
+    perturbation="beta",
+    concentration=50,
+    slope_sd=0.1,
+    intercept_sd=0.1,
+):
+    """
+    Returns a (scenarios x chances) array of plausible true xG values for a list of xG chances
+    "beta" draws every chance independently from a Beta distribution with mean equal to its xG, which is noisier
+    the lower the concentration. "calibration" passes every chance in a scenario through the same miscalibration
+    curve, logit(true xG) = slope * logit(xG) + intercept, with slope ~ N(1, slope_sd) and intercept ~ N(0, intercept_sd)
+    Chances with an xG of exactly 0 or 1 are left unchanged
+    """
+
+    if perturbation not in PERTURBATIONS:
+        raise ValueError(
+            f"perturbation must be one of {PERTURBATIONS}, not {perturbation!r}"
+        )
+
+    xg_of_chances = np.asarray(xg_of_chances, dtype=float)
+
+    perturbed_xg = np.tile(xg_of_chances, (number_of_scenarios, 1))
+
+    uncertain = (xg_of_chances > 0) & (xg_of_chances < 1)
+    xg = xg_of_chances[uncertain]
+
+    if perturbation == "beta":
+        perturbed_xg[:, uncertain] = rng.beta(
+            xg * concentration,
+            (1 - xg) * concentration,
+            size=(number_of_scenarios, len(xg)),
+        )
+    else:
+        slopes = rng.normal(1, slope_sd, size=(number_of_scenarios, 1))
+        intercepts = rng.normal(0, intercept_sd, size=(number_of_scenarios, 1))
+
+        log_odds = slopes * (np.log(xg) - np.log1p(-xg)) + intercepts
+        perturbed_xg[:, uncertain] = 1 / (1 + np.exp(-log_odds))
+
+    return perturbed_xg
+
+
+@metrics.instrument("xg_sweep")
+def sweep_xg_uncertainty(
+    home_xg,
+    away_xg,
+    home_goals=None,
+    away_goals=None,
+    number_of_scenarios=100,
+    perturbation="beta",
+    concentration=50,
+    slope_sd=0.1,
+    intercept_sd=0.1,
+    seed=SEED,
+):
+    """
+    Calculates exact outcome probabilities under number_of_scenarios perturbations of the xG of every chance
+    (see perturb_xg, where "calibration" scenarios apply the same curve to both teams)
+    The goal distributions of both teams in every scenario come from one dynamic programme over a
+    (2 * scenarios x chances) array, so the scenarios share a single pass over the shots
+    Returns a dict of 1D arrays with one element per scenario: home_win, draw, away_win and,
+    if the observed score is given, actual_score
+    """
+
+    # chances are sorted so equivalent shot lists get the same perturbations, as they share a seed
+    home_xg = np.sort(np.asarray(home_xg, dtype=float))
+    away_xg = np.sort(np.asarray(away_xg, dtype=float))
+
+    rng = get_generator(
+        get_seed_sequence(
+            seed,
+            "sweep",
+            canonical_xg(home_xg),
+            canonical_xg(away_xg),
+            int(number_of_scenarios),
+            perturbation,
+            float(concentration),
+            float(slope_sd),
+            float(intercept_sd),
+        )
+    )
+
+    perturbed_xg = perturb_xg(
+        rng,
+        np.concatenate([home_xg, away_xg]),
+        number_of_scenarios,
+        perturbation,
+        concentration,
+        slope_sd,
+        intercept_sd,
+    )
+
+    max_shots = max(len(home_xg), len(away_xg))
+    xg = np.zeros((2 * number_of_scenarios, max_shots))
+    xg[:number_of_scenarios, : len(home_xg)] = perturbed_xg[:, : len(home_xg)]
+    xg[number_of_scenarios:, : len(away_xg)] = perturbed_xg[:, len(home_xg) :]
+
+    goal_distributions = calculate_padded_goal_distributions(xg)
+    home_distributions = goal_distributions[:number_of_scenarios]
+    away_distributions = goal_distributions[number_of_scenarios:]
+
+    home_win, draw, away_win = get_match_probabilities(
+        home_distributions, away_distributions
+    )
+
+    sweep = {"home_win": home_win, "draw": draw, "away_win": away_win}
+
+    if home_goals is not None and away_goals is not None:
+        if home_goals <= max_shots and away_goals <= max_shots:
+            sweep["actual_score"] = (
+                home_distributions[:, int(home_goals)]
+                * away_distributions[:, int(away_goals)]
+            )
+        else:
+            sweep["actual_score"] = np.zeros(number_of_scenarios)
+
+    return sweep
+
+
+def get_sweep_bands(sweep, coverage=0.9):
+    """
+    Returns the lower bound, median and upper bound of the central coverage interval of each outcome
+    in a sweep from sweep_xg_uncertainty, as a dict of (low, median, high) tuples
+    """
+
+    tail = (1 - coverage) / 2
+
+    return {
+        outcome: tuple(np.quantile(values, [tail, 0.5, 1 - tail]).tolist())
+        for outcome, values in sweep.items()
+    }
+
+
+@metrics.instrument("exact_probabilities")
+def get_exact_match_outcomes(home_xg, away_xg):
+    """
+    Calculates the exact probability of every scoreline without simulation
+    Returns a 2D array where element [i, j] is the probability of the home team scoring i and the away team scoring j
+    """
+
+    return np.outer(get_goal_distribution(home_xg), get_goal_distribution(away_xg))
+
+
+def get_score_matrix(match_outcomes):
+    """
+    Returns match outcomes as a 2D array of scoreline frequencies indexed by [home_goals, away_goals]
+    Accepts simulation counts from get_match_outcomes or probabilities from get_exact_match_outcomes
+    """
+
+    return np.asarray(match_outcomes, dtype=float)
+
+
+def get_outcome_probabilities(score_matrix):
+    """
+    Returns the proportion of home wins, draws and away wins in a scoreline table
+    """
+
+    total = score_matrix.sum()
+
+    home_win = np.tril(score_matrix, -1).sum() / total
+    draw = np.trace(score_matrix) / total
+    away_win = np.triu(score_matrix, 1).sum() / total
+
+    return home_win, draw, away_win
+
+
+def get_margin_distribution(score_matrix):
+    """
+    Returns the possible home margins and the proportion of the scoreline table at each margin
+    """
+
+    number_of_home_scores, number_of_away_scores = score_matrix.shape
+
+    home_margins = np.arange(-(number_of_away_scores - 1), number_of_home_scores)
+    # a diagonal with offset k holds the scorelines where away goals - home goals = k
+    proportions = np.array(
+        [np.trace(score_matrix, offset=-margin) for margin in home_margins]
+    )
+
+    return home_margins, proportions / score_matrix.sum()
+
+
+def get_score_probability(score_matrix, home_goals, away_goals):
+    """
+    Returns the proportion of a scoreline table matching an exact score, which is zero for scores outside the table
+    """
+
+    if home_goals < score_matrix.shape[0] and away_goals < score_matrix.shape[1]:
+        return score_matrix[int(home_goals), int(away_goals)] / score_matrix.sum()
+
+    return 0.0
+
+
+@metrics.instrument("aggregation")
+def get_sims_matching_score(
+    match_outcomes, home_team_observed_goals, away_team_observed_goals
+):
+    score_matrix = get_score_matrix(match_outcomes)
+
+    percentage_of_sims_matching_actual_score = get_score_probability(
+        score_matrix, home_team_observed_goals, away_team_observed_goals
+    )
+
+    home_win, draw, away_win = get_outcome_probabilities(score_matrix)
+
+    simulated_home_win_percent = f"{home_win:.1%}"
+    simulated_away_win_percent = f"{away_win:.1%}"
+    simulated_draw_percent = f"{draw:.1%}"
+
+    return (
+        simulated_home_win_percent,
+        simulated_away_win_percent,
+        simulated_draw_percent,
+        percentage_of_sims_matching_actual_score,
+    )
+
+
+def get_outcome_codes(home_margin):
+    """
+    Returns the outcome of each home margin as an int8 index into OUTCOME_LABELS
+    """
+
+    return (np.sign(home_margin) + 1).astype(np.int8)
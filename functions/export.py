@@ -0,0 +1,313 @@
+"""
+Bulk export of plot_margins graphics, e.g. for every match in a round or season
+
+Each worker process builds one MarginsTemplate, a figure with the plot_margins layout, and re-renders it for
+each match by updating the bar heights, axis limits and title in place, rather than building subplots and a
+seaborn histogram per match. Matches are rendered across a process pool and written as PNG, SVG or WebP files.
+A manifest.json in the output directory records a digest of what each file was rendered from, so re-running
+an export skips files whose match, format and dpi are unchanged.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+
+from functions import simulate
+
+FORMATS = ["png", "svg", "webp"]
+DEFAULT_DPI = 300
+
+# bump when the template's appearance changes, so previously exported files are rendered again
+TEMPLATE_VERSION = 3
+
+MANIFEST_NAME = "manifest.json"
+
+# margins the template starts with bars for; it grows if a match has a wider range
+DEFAULT_MAX_MARGIN = 10
+
+
+class MarginsTemplate:
+    """
+    A reusable plot_margins figure, re-rendered for each match by render()
+    """
+
+    def __init__(self, dpi=DEFAULT_DPI, source=None, app_url=None):
+        import matplotlib.ticker as mtick
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        # a bare Figure is not tracked by pyplot, so it never needs closing
+        self.fig = Figure(figsize=(8, 8), dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.subplots(nrows=3, height_ratios=[8.5, 12, 3.5])
+
+        self.ax[0].set_axis_off()
+        self.ax[2].set_axis_off()
+
+        self.ax[1].spines["top"].set_visible(False)
+        self.ax[1].spines["right"].set_visible(False)
+        self.ax[1].set_ylabel("Percent of Simulations")
+        self.ax[1].set_xlabel("Full Time Margin (Home Team Goals - Away Team Goals)")
+        self.ax[1].yaxis.set_major_formatter(mtick.PercentFormatter(1, 0))
+        # whole goal margins only, as on the app's plot_margins figure
+        self.ax[1].xaxis.set_major_locator(mtick.MaxNLocator(integer=True))
+
+        self.ax[2].text(
+            x=0.99,
+            y=0,
+            s=simulate.get_footer_text(source, app_url),
+            horizontalalignment="right",
+            fontstyle="italic",
+        )
+
+        self.bars = None
+        self.margins = np.zeros(0, dtype=int)
+        self.set_margin_range(DEFAULT_MAX_MARGIN)
+
+        # plot_margins' tight_layout call is not applied once its title is drawn, so the layout is left as is
+        self.title = None
+
+    def set_margin_range(self, max_margin):
+        """
+        Replaces the bars with one per margin from -max_margin to max_margin, coloured by match outcome
+        """
+
+        if self.bars is not None:
+            self.bars.remove()
+
+        self.margins = np.arange(-max_margin, max_margin + 1)
+        outcome_labels = np.array(simulate.OUTCOME_LABELS)[
+            simulate.get_outcome_codes(self.margins)
+        ]
+
+        # matches the bars drawn by sns.histplot(discrete=True) in plot_margins
+        self.bars = self.ax[1].bar(
+            self.margins,
+            np.zeros(len(self.margins)),
+            width=1,
+            color=[simulate.outcome_colours[label] for label in outcome_labels],
+            edgecolor="black",
+            linewidth=1,
+            zorder=1,
+        )
+
+    def update(self, score_matrix, title_args):
+        """
+        Redraws the margin bars, axis limits and title for a scoreline table
+        title_args are the arguments of simulate.get_margins_title, as returned by get_title_args
+        """
+
+        from highlight_text import HighlightText
+
+        home_margins, proportions = simulate.get_margin_distribution(score_matrix)
+
+        max_margin = int(np.abs(home_margins).max())
+        if max_margin > self.margins[-1]:
+            self.set_margin_range(max_margin)
+
+        heights = np.zeros(len(self.margins))
+        heights[home_margins - self.margins[0]] = proportions
+        for bar, height in zip(self.bars, heights.tolist()):
+            bar.set_height(height)
+
+        # plot_margins only draws margins with a non-zero proportion, and autoscales to them
+        drawn_margins = home_margins[proportions > 0]
+        low = drawn_margins.min() - 0.5
+        high = drawn_margins.max() + 0.5
+        padding = 0.05 * (high - low)
+        self.ax[1].set_xlim(low - padding, high + padding)
+        self.ax[1].set_ylim(0, 1.05 * proportions.max())
+
+        if self.title is not None:
+            self.title.annotation_bbox.remove()
+
+        # added without HighlightText's own add_artist, which draws the whole figure to get a renderer
+        self.title = HighlightText(
+            x=0.12,
+            y=0.9,
+            s=simulate.get_margins_title(*title_args),
+            fontsize=14,
+            highlight_textprops=simulate.MARGINS_TITLE_HIGHLIGHTS,
+            annotationbbox_kw={"boxcoords": self.fig.transFigure},
+            ax=self.ax[2],
+            fig=self.fig,
+            add_artist=False,
+        )
+        self.ax[2].add_artist(self.title.annotation_bbox)
+
+    def render(self, score_matrix, title_args, paths):
+        """
+        Updates the figure for a scoreline table and saves it to each path, in the format of its extension
+        """
+
+        import matplotlib.image as mimage
+
+        self.update(score_matrix, title_args)
+
+        # the figure is drawn once and the pixels shared by every raster format, where savefig would redraw it
+        drawn = False
+        for path in paths:
+            fmt = pathlib.Path(path).suffix[1:]
+
+            if fmt == "svg":
+                self.fig.savefig(path, format=fmt)
+                continue
+
+            if not drawn:
+                self.fig.canvas.draw()
+                drawn = True
+
+            mimage.imsave(
+                path,
+                self.fig.canvas.buffer_rgba(),
+                format=fmt,
+                origin="upper",
+                dpi=self.fig.dpi,
+            )
+
+
+def get_title_args(match):
+    """
+    Returns the get_margins_title arguments for a match dict with a score_matrix, team names, total xG and,
+    optionally, the observed home_goals and away_goals. Without both, the title leaves out the observed score
+    """
+
+    score_matrix = match["score_matrix"]
+    home_win, draw, away_win = simulate.get_outcome_probabilities(score_matrix)
+
+    home_goals = match.get("home_goals")
+    away_goals = match.get("away_goals")
+    observed = not (
+        home_goals is None
+        or away_goals is None
+        or np.isnan(home_goals)
+        or np.isnan(away_goals)
+    )
+
+    return (
+        home_goals if observed else None,
+        away_goals if observed else None,
+        f"{home_win:.1%}",
+        f"{draw:.1%}",
+        f"{away_win:.1%}",
+        (
+            simulate.get_score_probability(score_matrix, home_goals, away_goals)
+            if observed
+            else None
+        ),
+        match["home_xg"],
+        match["away_xg"],
+        match.get("match_date"),
+        match["home_team"],
+        match["away_team"],
+        match.get("extra_plot_comment", ""),
+        observed,
+    )
+
+
+def get_render_digest(score_matrix, title_args, source, app_url, dpi, fmt):
+    """
+    Returns a digest of everything an exported file is rendered from
+    """
+
+    digest = hashlib.sha1(
+        repr((TEMPLATE_VERSION, title_args, source, app_url, dpi, fmt)).encode()
+    )
+    digest.update(str(score_matrix.shape).encode())
+    digest.update(np.ascontiguousarray(score_matrix, dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir):
+    try:
+        with open(pathlib.Path(output_dir) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# one template per worker process, built by init_worker
+template = None
+
+
+def init_worker(dpi, source, app_url):
+    global template
+
+    template = MarginsTemplate(dpi, source, app_url)
+
+
+def render_job(job):
+    score_matrix, title_args, paths = job
+    template.render(score_matrix, title_args, paths)
+
+
+def export_margins(
+    matches,
+    output_dir,
+    formats=("png",),
+    dpi=DEFAULT_DPI,
+    workers=None,
+    source=None,
+    app_url=None,
+):
+    """
+    Writes a plot_margins graphic of each match to output_dir/<match_id>.<format> for every format
+    Each match is a dict for get_title_args with a match_id. Files whose inputs are unchanged since the
+    last export to output_dir are skipped. workers is the number of processes (default: one per CPU)
+    Returns the number of files written and the number skipped
+    """
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = load_manifest(output_dir)
+
+    jobs = []
+    digests = {}
+    skipped = 0
+    for match in matches:
+        score_matrix = simulate.get_score_matrix(match["score_matrix"])
+        title_args = get_title_args(match)
+
+        paths = []
+        for fmt in formats:
+            file_name = f"{match['match_id']}.{fmt}"
+            digest = get_render_digest(
+                score_matrix, title_args, source, app_url, dpi, fmt
+            )
+
+            if manifest.get(file_name) == digest and (output_dir / file_name).exists():
+                skipped += 1
+                continue
+
+            paths.append(str(output_dir / file_name))
+            digests[file_name] = digest
+
+        if paths:
+            jobs.append((score_matrix, title_args, paths))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(dpi, source, app_url)
+        ) as executor:
+            list(executor.map(render_job, jobs, chunksize=4))
+    elif jobs:
+        init_worker(dpi, source, app_url)
+        for job in jobs:
+            render_job(job)
+
+    # only recorded once every file has been written, so an interrupted export renders them all again
+    manifest.update(digests)
+    with open(output_dir / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return len(digests), skipped
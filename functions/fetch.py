@@ -0,0 +1,163 @@
+"""
+Fetchers for FotMob match details
+
+Every fetcher has fetch_match(match_id), returning the decoded matchDetails JSON, and fetch_matches(match_ids),
+which fetches many matches concurrently. FotMobFetcher talks to the FotMob API (or a stub server at another
+base_url) and FixtureFetcher reads saved responses from a directory, so either can be passed wherever a fetcher is used.
+"""
+
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+FOTMOB_API_URL = "https://www.fotmob.com/api/"
+MATCH_DETAILS_PATH = "matchDetails"
+
+DEFAULT_CACHE_DIR = pathlib.Path(tempfile.gettempdir()) / "xg_simulator_fotmob"
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_TIMEOUT = 10
+DEFAULT_CONCURRENCY = 8
+
+
+class DiskCache:
+    """
+    Stores JSON responses as files in a directory, treating files older than ttl seconds as missing
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        self.directory = pathlib.Path(directory)
+        self.ttl = ttl
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / (hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+
+        # write to a temporary file first so concurrent readers never see a partial response
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.replace(temporary_path, path)
+
+
+class MatchFetcher(abc.ABC):
+    """
+    Base class for fetchers, providing concurrent bulk fetching on top of fetch_match
+    """
+
+    @abc.abstractmethod
+    def fetch_match(self, match_id):
+        """
+        Returns the decoded matchDetails JSON for a match
+        """
+
+    async def fetch_matches_async(self, match_ids, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Fetches many matches with at most concurrency requests in flight
+        Returns a dict mapping each match ID to its match details, or to the exception raised fetching it
+        """
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(match_id):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(self.fetch_match, match_id)
+                except Exception as error:
+                    return error
+
+        responses = await asyncio.gather(*[fetch(match_id) for match_id in match_ids])
+
+        return dict(zip(match_ids, responses))
+
+    def fetch_matches(self, match_ids, concurrency=DEFAULT_CONCURRENCY):
+        return asyncio.run(self.fetch_matches_async(match_ids, concurrency))
+
+
+class FotMobFetcher(MatchFetcher):
+    """
+    Fetches match details from the FotMob API over a pooled session with timeouts and retries
+    Responses are cached on disk for ttl seconds unless cache_dir is None
+    """
+
+    def __init__(
+        self,
+        base_url=FOTMOB_API_URL,
+        cache_dir=DEFAULT_CACHE_DIR,
+        ttl=DEFAULT_TTL,
+        timeout=DEFAULT_TIMEOUT,
+        retries=3,
+        pool_size=DEFAULT_CONCURRENCY,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.cache = DiskCache(cache_dir, ttl) if cache_dir is not None else None
+
+        # requests is only imported once a fetcher is created, so importing this module stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch_match(self, match_id):
+        url = self.base_url + MATCH_DETAILS_PATH
+        cache_key = url + "?matchId=" + str(match_id)
+
+        if self.cache is not None:
+            match_summary = self.cache.get(cache_key)
+            if match_summary is not None:
+                return match_summary
+
+        response = self.session.get(
+            url, params={"matchId": match_id}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        match_summary = response.json()
+
+        if self.cache is not None:
+            self.cache.put(cache_key, match_summary)
+
+        return match_summary
+
+
+class FixtureFetcher(MatchFetcher):
+    """
+    Reads match details saved as <directory>/<match_id>.json, e.g. by batch.py fetch
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+
+    def fetch_match(self, match_id):
+        with open(self.directory / f"{match_id}.json") as f:
+            return json.load(f)
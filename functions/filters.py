@@ -0,0 +1,90 @@
+"""
+Vectorised shot filtering over an array-backed shot table
+
+A shot table is a dict of equal-length NumPy arrays with one element per shot: xg, is_home, minute, period,
+situation, player and outcome. Filters are keyword arguments to get_mask, and a list of filters (variants of
+the same match, e.g. "90 minutes only" or "NPxG") becomes a (variants x shots) boolean matrix that
+simulate.simulate_variants can simulate in one batched call.
+"""
+
+import numpy as np
+
+REGULATION_PERIODS = ["FirstHalf", "SecondHalf"]
+EXTRA_TIME_PERIODS = ["FirstHalfExtra", "SecondHalfExtra"]
+PENALTY_SHOOTOUT_PERIODS = ("PenaltyShootout",)
+
+
+def shot_table_from_fotmob(shots, home_team_id):
+    """
+    Converts the shots in FotMob match details (match_summary["content"]["shotmap"]["shots"]) into a shot table
+    """
+
+    return {
+        "xg": np.array([shot["expectedGoals"] for shot in shots], dtype=float),
+        "is_home": np.array(
+            [shot["teamId"] == home_team_id for shot in shots], dtype=bool
+        ),
+        "minute": np.array([shot["min"] for shot in shots], dtype=int),
+        "period": np.array([shot["period"] for shot in shots], dtype=str),
+        "situation": np.array([shot["situation"] for shot in shots], dtype=str),
+        "player": np.array([shot["playerName"] for shot in shots], dtype=str),
+        "outcome": np.array([shot["eventType"] for shot in shots], dtype=str),
+    }
+
+
+def get_mask(
+    shot_table,
+    periods=None,
+    exclude_periods=PENALTY_SHOOTOUT_PERIODS,
+    situations=None,
+    exclude_situations=None,
+    minute_range=None,
+    players=None,
+):
+    """
+    Returns a boolean array selecting the shots that pass every given filter
+    minute_range is a (first, last) pair of minutes, either of which can be None, e.g. (None, red_card_minute - 1)
+    for the game state before a red card. Penalty shootout kicks are excluded unless exclude_periods is changed
+    """
+
+    mask = np.ones(len(shot_table["xg"]), dtype=bool)
+
+    if periods is not None:
+        mask &= np.isin(shot_table["period"], periods)
+    if exclude_periods:
+        mask &= ~np.isin(shot_table["period"], exclude_periods)
+    if situations is not None:
+        mask &= np.isin(shot_table["situation"], situations)
+    if exclude_situations:
+        mask &= ~np.isin(shot_table["situation"], exclude_situations)
+    if players is not None:
+        mask &= np.isin(shot_table["player"], players)
+    if minute_range is not None:
+        first_minute, last_minute = minute_range
+        if first_minute is not None:
+            mask &= shot_table["minute"] >= first_minute
+        if last_minute is not None:
+            mask &= shot_table["minute"] <= last_minute
+
+    return mask
+
+
+def get_masks(shot_table, variants):
+    """
+    Returns a (variants x shots) boolean matrix with one get_mask row per dict of filters in variants
+    """
+
+    return np.stack([get_mask(shot_table, **filters) for filters in variants]).reshape(
+        len(variants), len(shot_table["xg"])
+    )
+
+
+def get_red_card_variants(red_card_minute):
+    """
+    Returns filters splitting a match into the game states before and after a red card
+    """
+
+    return {
+        "Before red card": {"minute_range": (None, red_card_minute - 1)},
+        "After red card": {"minute_range": (red_card_minute, None)},
+    }
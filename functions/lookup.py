@@ -0,0 +1,170 @@
+"""
+Precomputed goal distributions for common xG profiles
+
+A lookup table holds the exact goal distribution (Poisson-binomial PMF) of many xG multisets whose values are
+multiples of a quantum (0.01 by default). Tables are written to a directory of .npy files and memory-mapped when
+opened, and install() makes core.get_goal_distributions answer from the table whenever every xG value in an
+input is within tolerance of a quantised value. Inputs without a match in the table are calculated as usual.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+
+import numpy as np
+
+from functions import core
+
+# directory of a table for applications to install at startup, if set
+LOOKUP_TABLE_DIR = os.environ.get("XG_SIMULATOR_LOOKUP_TABLE")
+
+DEFAULT_QUANTUM = 0.01
+DEFAULT_TOLERANCE = 1e-9
+
+# xG values are stored as integer multiples of the quantum, so the quantum can be as small as 1 / 65535
+QUANTA_DTYPE = np.uint16
+
+# round xG values and the default custom match inputs, used by build_lookup_table when no profiles are given
+ROUND_XG_VALUES = [0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.76, 0.8, 0.9]
+DEFAULT_PROFILES = [[0.8], [0.2, 0.2, 0.2, 0.2]]
+
+
+def get_profile_key(quanta):
+    """
+    Returns a 64-bit integer identifying a sorted list of xG quanta
+    """
+
+    digest = hashlib.blake2b(
+        np.asarray(quanta, dtype=QUANTA_DTYPE).tobytes(), digest_size=8
+    )
+
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+def iter_round_profiles(values=ROUND_XG_VALUES, max_shots=6):
+    """
+    Yields every multiset of at most max_shots xG values drawn from values
+    """
+
+    for number_of_shots in range(max_shots + 1):
+        yield from itertools.combinations_with_replacement(values, number_of_shots)
+
+
+def build_lookup_table(directory, xg_lists=None, quantum=DEFAULT_QUANTUM):
+    """
+    Writes the goal distributions of xg_lists (by default round xG profiles and the default custom inputs)
+    to a lookup table directory, after rounding every xG value to a multiple of quantum
+    Returns the number of distinct profiles in the table
+    """
+
+    if xg_lists is None:
+        xg_lists = itertools.chain(DEFAULT_PROFILES, iter_round_profiles())
+
+    profiles = {}
+    for xg_of_chances in xg_lists:
+        quanta = np.sort(
+            np.rint(np.asarray(xg_of_chances, dtype=float) / quantum).astype(
+                QUANTA_DTYPE
+            )
+        )
+        profiles[get_profile_key(quanta.tolist())] = quanta
+
+    keys = np.array(sorted(profiles), dtype=np.int64)
+    quanta_lists = [profiles[key] for key in keys.tolist()]
+
+    goal_distributions = core.get_goal_distributions(
+        [quanta * quantum for quanta in quanta_lists]
+    )
+
+    # profile k has offsets[k + 1] - offsets[k] - 1 shots, so the same offsets index both the quanta and the PMFs
+    lengths = np.array([len(quanta) + 1 for quanta in quanta_lists], dtype=np.int64)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    np.save(directory / "keys.npy", keys)
+    np.save(directory / "offsets.npy", offsets)
+    np.save(
+        directory / "quanta.npy",
+        np.concatenate([np.zeros(0, dtype=QUANTA_DTYPE), *quanta_lists]),
+    )
+    np.save(
+        directory / "pmfs.npy",
+        np.concatenate(
+            [
+                goal_distributions[k, :length]
+                for k, length in enumerate(lengths.tolist())
+            ]
+            or [np.zeros(0)]
+        ),
+    )
+
+    with open(directory / "meta.json", "w") as f:
+        json.dump({"quantum": quantum}, f)
+
+    return len(keys)
+
+
+class LookupTable:
+    """
+    Read-only, memory-mapped view of a table written by build_lookup_table
+    """
+
+    def __init__(self, directory, tolerance=DEFAULT_TOLERANCE):
+        self.directory = pathlib.Path(directory)
+        self.tolerance = tolerance
+
+        with open(self.directory / "meta.json") as f:
+            self.quantum = json.load(f)["quantum"]
+
+        self.keys = np.load(self.directory / "keys.npy", mmap_mode="r")
+        self.offsets = np.load(self.directory / "offsets.npy", mmap_mode="r")
+        self.quanta = np.load(self.directory / "quanta.npy", mmap_mode="r")
+        self.pmfs = np.load(self.directory / "pmfs.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, xg_of_chances):
+        """
+        Returns the goal distribution of a list of xG chances as a read-only view into the table,
+        or None if any value is not within tolerance of a multiple of the quantum or the profile is not in the table
+        """
+
+        # inputs are short, so quantising them with plain floats is faster than with NumPy
+        quanta = []
+        for shot_xg in xg_of_chances:
+            quantum = round(float(shot_xg) / self.quantum)
+            if (
+                not 0 <= quantum <= np.iinfo(QUANTA_DTYPE).max
+                or abs(shot_xg - quantum * self.quantum) > self.tolerance
+            ):
+                return None
+            quanta.append(quantum)
+
+        quanta = sorted(quanta)
+
+        key = get_profile_key(quanta)
+        k = int(np.searchsorted(self.keys, key))
+        if k == len(self.keys) or self.keys[k] != key:
+            return None
+
+        start, end = self.offsets[k : k + 2]
+        if self.quanta[start - k : end - k - 1].tolist() != quanta:
+            return None
+
+        return self.pmfs[start:end]
+
+
+def install(directory, tolerance=DEFAULT_TOLERANCE):
+    """
+    Opens a lookup table and makes core.get_goal_distributions answer from it, returning the table
+    """
+
+    core.lookup_table = LookupTable(directory, tolerance)
+
+    return core.lookup_table
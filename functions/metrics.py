@@ -0,0 +1,106 @@
+"""
+Optional per-stage timing and memory instrumentation
+
+Set the environment variable XG_SIMULATOR_METRICS=1 before importing to enable it. When it is not set,
+instrument() returns functions undecorated and timed() returns a shared no-op context manager, so
+instrumented code runs exactly as it would without the hooks.
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+ENABLED = os.environ.get("XG_SIMULATOR_METRICS", "0") not in ["", "0"]
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_disabled_context = contextlib.nullcontext()
+
+
+def reset():
+    """
+    Starts a new list of stage records for the current thread (e.g. at the top of each Streamlit rerun) and returns it
+    """
+
+    _local.records = []
+    return _local.records
+
+
+def get_records():
+    return getattr(_local, "records", [])
+
+
+@contextlib.contextmanager
+def _timed(stage):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    # tracemalloc keeps a single peak, so each enclosing stage's peak so far is kept on a stack
+    # before the peak is reset for this stage, and folded back in when this stage ends
+    peaks = _local.__dict__.setdefault("peaks", [])
+
+    start_memory, current_peak = tracemalloc.get_traced_memory()
+    if peaks:
+        peaks[-1] = max(peaks[-1], current_peak)
+    peaks.append(0)
+    tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+
+        end_memory, current_peak = tracemalloc.get_traced_memory()
+        peak_memory = max(peaks.pop(), current_peak)
+        if peaks:
+            peaks[-1] = max(peaks[-1], peak_memory)
+
+        record = {
+            "stage": stage,
+            "seconds": seconds,
+            "peak_memory_bytes": peak_memory - start_memory,
+            "retained_memory_bytes": end_memory - start_memory,
+        }
+
+        get_records().append(record)
+        logger.info(json.dumps(record))
+
+
+def timed(stage):
+    """
+    Context manager recording the wall time and traced memory of a block as one stage
+    Stages can be nested, in which case the enclosing stage's figures include the nested stage
+    """
+
+    if not ENABLED:
+        return _disabled_context
+
+    return _timed(stage)
+
+
+def instrument(stage):
+    """
+    Decorator recording every call of a function as a stage with timed()
+    """
+
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _timed(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
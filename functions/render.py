@@ -0,0 +1,124 @@
+"""
+Cached PNG rendering of the plots in functions.simulate
+
+matplotlib is imported when a figure is first rendered rather than when this module is imported.
+"""
+
+import hashlib
+import io
+
+import numpy as np
+
+from functions import cache, metrics, simulate
+
+figure_cache = cache.LRUCache(maxsize=64)
+
+
+def hash_match_outcomes(match_outcomes):
+    """
+    Returns a short digest identifying a scoreline table by its shape and values
+    """
+
+    score_matrix = np.ascontiguousarray(simulate.get_score_matrix(match_outcomes))
+
+    digest = hashlib.sha1(str(score_matrix.shape).encode())
+    digest.update(score_matrix.tobytes())
+
+    return digest.hexdigest()
+
+
+def figure_to_png(fig):
+    """
+    Encodes a figure as PNG bytes and closes it so it is not kept alive by pyplot
+    """
+
+    import matplotlib.pyplot as plt
+
+    img = io.BytesIO()
+
+    try:
+        with metrics.timed("png_encoding"):
+            fig.savefig(img, format="png")
+    finally:
+        plt.close(fig)
+
+    return img.getvalue()
+
+
+def render_margins(match_outcomes, *args, **kwargs):
+    """
+    Renders plot_margins to PNG bytes, returning the bytes and the plot title string
+    Renders are cached on the scoreline table, every plot argument and the figure dpi
+    """
+
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    key = (
+        "margins",
+        hash_match_outcomes(match_outcomes),
+        args,
+        tuple(sorted(kwargs.items())),
+        mpl.rcParams["figure.dpi"],
+    )
+
+    def render():
+        img = io.BytesIO()
+
+        fig, ax, plot_title = simulate.plot_margins(
+            match_outcomes, *args, io=img, **kwargs
+        )
+        plt.close(fig)
+
+        return img.getvalue(), plot_title
+
+    return figure_cache.get_or_compute(key, render)
+
+
+def render_exact_scores(match_outcomes):
+    """
+    Renders plot_exact_scores to PNG bytes, cached on the scoreline table and the figure dpi
+    """
+
+    import matplotlib as mpl
+
+    key = (
+        "exact_scores",
+        hash_match_outcomes(match_outcomes),
+        mpl.rcParams["figure.dpi"],
+    )
+
+    def render():
+        fig, ax = simulate.plot_exact_scores(match_outcomes)
+
+        return figure_to_png(fig)
+
+    return figure_cache.get_or_compute(key, render)
+
+
+def render_timeline(timeline, home_team="Home team", away_team="Away team"):
+    """
+    Renders plot_timeline to PNG bytes, cached on the timeline, team names and the figure dpi
+    """
+
+    import matplotlib as mpl
+
+    digest = hashlib.sha1()
+    for name, values in sorted(timeline.items()):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+
+    key = (
+        "timeline",
+        digest.hexdigest(),
+        home_team,
+        away_team,
+        mpl.rcParams["figure.dpi"],
+    )
+
+    def render():
+        fig, ax = simulate.plot_timeline(timeline, home_team, away_team)
+
+        return figure_to_png(fig)
+
+    return figure_cache.get_or_compute(key, render)
@@ -0,0 +1,240 @@
+"""
+Columnar on-disk store of shots for historical matches
+
+A store is a directory of .npy column files plus a categories.json file. Shots are ordered by match, then
+home shots before away shots, so each team's shots in a match are one contiguous slice of every column.
+Columns are memory-mapped when a store is opened, so reading a match's xG returns views without copying or
+parsing anything. Text columns (period, situation, player and team names) are stored as integer codes.
+"""
+
+import json
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+SHOT_COLUMNS = {
+    "xg": np.float64,
+    "minute": np.int16,
+    "period": np.int16,
+    "situation": np.int16,
+    "player": np.int32,
+    "is_goal": np.bool_,
+    "possession": np.int64,
+}
+
+CATEGORICAL_COLUMNS = ["period", "situation", "player"]
+
+
+def shots_from_fotmob(match_summary):
+    """
+    Converts FotMob match details into a DataFrame with one row per shot, in the layout used by batch.py and build_shot_store
+    """
+
+    general = match_summary["general"]
+    home_team_id = general["homeTeam"]["id"]
+
+    shots = match_summary["content"]["shotmap"]["shots"]
+
+    return pd.DataFrame(
+        {
+            "match_id": [general["matchId"]] * len(shots),
+            "team": [
+                (
+                    general["homeTeam"]["name"]
+                    if shot["teamId"] == home_team_id
+                    else general["awayTeam"]["name"]
+                )
+                for shot in shots
+            ],
+            "venue": [
+                "home" if shot["teamId"] == home_team_id else "away" for shot in shots
+            ],
+            "xG": [shot["expectedGoals"] for shot in shots],
+            "minute": [shot["min"] for shot in shots],
+            "period": [shot["period"] for shot in shots],
+            "situation": [shot["situation"] for shot in shots],
+            "player": [shot["playerName"] for shot in shots],
+            "outcome": [shot["eventType"] for shot in shots],
+        }
+    )
+
+
+def get_possession_codes(possession):
+    """
+    Returns possession IDs as integer codes, with -1 for shots without an ID (missing or blank)
+    Only equality of IDs matters (see core.group_chances), so the codes need no category list
+    """
+
+    possession = pd.Series(possession).reset_index(drop=True)
+    missing = (
+        possession.isna() | (possession.astype(str).str.strip() == "")
+    ).to_numpy()
+
+    codes = np.full(len(possession), -1, dtype=np.int64)
+    codes[~missing] = np.unique(
+        possession[~missing].to_numpy(dtype=str), return_inverse=True
+    )[1]
+
+    return codes
+
+
+def get_possession_groups(possession_codes):
+    """
+    Returns group IDs for core.group_chances from get_possession_codes output, making every shot without a
+    possession ID a chance of its own rather than grouping them all together
+    """
+
+    possession_codes = np.asarray(possession_codes)
+
+    return np.where(
+        possession_codes >= 0, possession_codes, -1 - np.arange(len(possession_codes))
+    )
+
+
+def build_shot_store(df_shots, directory):
+    """
+    Writes a DataFrame of shots to a store directory
+    Requires the columns match_id, team, venue ("home"/"away") and xG, with minute, period, situation, player,
+    outcome ("Goal" for scored shots) and possession stored when present
+    Possession IDs are stored as integer codes from get_possession_codes, so shots without one hold -1
+    """
+
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    df_shots = df_shots.reset_index(drop=True)
+    df_shots["is_away"] = df_shots["venue"] == "away"
+
+    # a stable sort keeps each team's shots in their original (time) order
+    df_shots = df_shots.sort_values(["match_id", "is_away"], kind="stable")
+
+    match_ids, match_codes = np.unique(
+        df_shots["match_id"].to_numpy(), return_inverse=True
+    )
+    if match_ids.dtype == object:
+        match_ids = match_ids.astype(str)
+    team_codes = match_codes * 2 + df_shots["is_away"].to_numpy()
+
+    # offsets[2k]:offsets[2k + 1] are match k's home shots and offsets[2k + 1]:offsets[2k + 2] its away shots
+    offsets = np.zeros(2 * len(match_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(team_codes, minlength=2 * len(match_ids)))
+
+    categories = {}
+
+    teams = df_shots.groupby(["match_id", "is_away"])["team"].first()
+    team_names, team_name_codes = np.unique(
+        teams.to_numpy(dtype=str), return_inverse=True
+    )
+    categories["team"] = team_names.tolist()
+
+    # every match gets a home and away team name, even if one side had no shots
+    match_teams = np.full((len(match_ids), 2), -1, dtype=np.int32)
+    match_teams[
+        np.searchsorted(match_ids, teams.index.get_level_values("match_id")),
+        teams.index.get_level_values("is_away").to_numpy(dtype=int),
+    ] = team_name_codes
+
+    columns = {
+        "xg": df_shots["xG"],
+        "minute": df_shots.get("minute", pd.Series(-1, index=df_shots.index)),
+        "is_goal": df_shots.get("outcome", pd.Series("", index=df_shots.index))
+        == "Goal",
+    }
+
+    columns["possession"] = get_possession_codes(
+        df_shots.get("possession", pd.Series(None, index=df_shots.index))
+    )
+
+    for column in CATEGORICAL_COLUMNS:
+        values = df_shots.get(column, pd.Series("", index=df_shots.index))
+        category_values, codes = np.unique(
+            values.to_numpy(dtype=str), return_inverse=True
+        )
+        categories[column] = category_values.tolist()
+        columns[column] = codes
+
+    np.save(directory / "match_ids.npy", match_ids)
+    np.save(directory / "offsets.npy", offsets)
+    np.save(directory / "match_teams.npy", match_teams)
+
+    for column, dtype in SHOT_COLUMNS.items():
+        np.save(directory / f"{column}.npy", np.asarray(columns[column], dtype=dtype))
+
+    with open(directory / "categories.json", "w") as f:
+        json.dump(categories, f)
+
+
+class ShotStore:
+    """
+    Read-only, memory-mapped view of a store written by build_shot_store
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+
+        self.match_ids = np.load(self.directory / "match_ids.npy")
+        self.offsets = np.load(self.directory / "offsets.npy", mmap_mode="r")
+        self.match_teams = np.load(self.directory / "match_teams.npy", mmap_mode="r")
+
+        self.columns = {
+            column: np.load(self.directory / f"{column}.npy", mmap_mode="r")
+            for column in SHOT_COLUMNS
+        }
+
+        with open(self.directory / "categories.json") as f:
+            self.categories = json.load(f)
+
+        self._match_index = {
+            match_id: k for k, match_id in enumerate(self.match_ids.tolist())
+        }
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def __contains__(self, match_id):
+        return match_id in self._match_index
+
+    def _slices(self, match_id):
+        k = self._match_index[match_id]
+        home_start, away_start, end = self.offsets[2 * k : 2 * k + 3]
+        return slice(home_start, away_start), slice(away_start, end)
+
+    def get_match_xg(self, match_id):
+        """
+        Returns the home and away xG arrays for a match as views into the memory-mapped store
+        """
+
+        home_slice, away_slice = self._slices(match_id)
+        xg = self.columns["xg"]
+
+        return xg[home_slice], xg[away_slice]
+
+    def get_match_shots(self, match_id):
+        """
+        Returns a dict of column views for the home team's shots and another for the away team's shots
+        """
+
+        return tuple(
+            {column: values[team_slice] for column, values in self.columns.items()}
+            for team_slice in self._slices(match_id)
+        )
+
+    def get_team_names(self, match_id):
+        home_code, away_code = self.match_teams[self._match_index[match_id]]
+        team_names = self.categories["team"]
+
+        return (
+            team_names[home_code] if home_code >= 0 else None,
+            team_names[away_code] if away_code >= 0 else None,
+        )
+
+    def get_code(self, column, value):
+        """
+        Returns the integer code of a category value (e.g. get_code("situation", "Penalty")), or -1 if it never occurs
+        """
+
+        try:
+            return self.categories[column].index(value)
+        except ValueError:
+            return -1
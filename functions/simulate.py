@@ -1,130 +1,128 @@
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
-import seaborn as sns
-from highlight_text import fig_text
+"""
+Simulation and plotting functions used by the app
+
+The computation lives in functions.core, which only needs NumPy, and its public names (core.__all__) are re-exported
+here so existing callers keep working. Runtime settings such as core.lookup_table and core.BIT_GENERATOR live only
+in functions.core. pandas, matplotlib, seaborn and highlight_text are imported when a plot is first drawn.
+"""
 
-N_SIMS = 100000
-SEED = 0
+import numpy as np
 
-rng = np.random.default_rng(SEED)
+from functions import metrics
+from functions.core import *
 
 outcome_colours = {"Home win": "#1c7ed6", "Draw": "#495057", "Away win": "#d6336c"}
 
 
-def simulate_chances(rng, number_of_sims, xg_of_chances):
+def get_outcome_labels(home_margin):
     """
-    Simulates goals scored given a list of xG chances
-    Returns a 1D array of size number_of_sims with each element being the goals scored in that simulation
+    Returns the outcome of each home margin as a categorical of OUTCOME_LABELS, without building a string per margin
     """
 
-    goals_scored = np.zeros(number_of_sims)
-
-    for i in range(number_of_sims):
-        for shot_xg in xg_of_chances:
-            random = rng.random()
-            if shot_xg >= random:
-                outcome = 1
-            else:
-                outcome = 0
-            goals_scored[i] = goals_scored[i] + outcome
-
-    return goals_scored
-
-
-def StringRepresentsFloat(s):
-    try:
-        float(s)
-        return str(float(s)) == s
-    except ValueError:
-        return False
+    import pandas as pd
 
-
-def xg_to_array(xg_string):
-    trimmed_array = [x.strip() for x in xg_string.split(",")]
-    # handle case where extra trailing comma is included
-    xg_array = [
-        float(trimmed_x)
-        for trimmed_x in trimmed_array
-        if StringRepresentsFloat(trimmed_x) and 0 < float(trimmed_x) < 1
-    ]
-    return xg_array
-
-
-def get_match_outcomes(home_goals, away_goals, home_margin):
-    match_outcomes = np.vstack((home_goals, away_goals, home_margin))
-
-    df_match_outcomes = pd.DataFrame(
-        match_outcomes.T, columns=["home_goals", "away_goals", "home_margin"]
+    return pd.Categorical.from_codes(
+        get_outcome_codes(home_margin), categories=OUTCOME_LABELS
     )
 
-    for column in ["home_goals", "away_goals", "home_margin"]:
-        df_match_outcomes[column] = df_match_outcomes[column].astype(int)
 
-    conditions = [
-        df_match_outcomes["home_margin"] > 0,
-        df_match_outcomes["home_margin"] < 0,
-    ]
+# styles of the highlighted <...> parts of the get_margins_title text, in order
+MARGINS_TITLE_HIGHLIGHTS = [
+    {"weight": "bold"},
+    {"color": outcome_colours["Home win"], "weight": "bold"},
+    {"color": outcome_colours["Away win"], "weight": "bold"},
+    {"color": outcome_colours["Draw"], "weight": "bold"},
+]
 
-    choices = ["Home win", "Away win"]
 
-    df_match_outcomes["match_outcome"] = np.select(
-        condlist=conditions, choicelist=choices, default="Draw"
-    )
+def get_margins_title(
+    home_team_observed_goals,
+    away_team_observed_goals,
+    simulated_home_win_percent,
+    simulated_draw_percent,
+    simulated_away_win_percent,
+    percentage_of_sims_matching_actual_score,
+    total_home_xg,
+    total_away_xg,
+    match_date=None,
+    home_team="Home team",
+    away_team="Away team",
+    extra_plot_comment="",
+    show_observed_score=True,
+):
+    """
+    Returns the highlight_text title of plot_margins, styled with MARGINS_TITLE_HIGHLIGHTS
+    Without show_observed_score, the actual outcome and exact scoreline lines are left out (e.g. for matches with
+    no recorded score), and the observed goals and exact scoreline proportion are ignored
+    """
 
-    df_match_outcomes["final_score"] = (
-        df_match_outcomes["home_goals"].apply(str)
-        + " - "
-        + df_match_outcomes["away_goals"].apply(str)
+    plot_title = (
+        home_team
+        + " (home) "
+        + f"{total_home_xg:.2f}"
+        + " xG - "
+        + away_team
+        + " (away) "
+        + f"{total_away_xg:.2f}"
+        + " xG"
     )
 
-    return df_match_outcomes
-
+    if match_date:
+        date_str = "\n" + f"{match_date:%d %B %Y}" + "\n"
+    else:
+        date_str = "\n"
 
-def get_sims_matching_score(
-    df_match_outcomes, home_team_observed_goals, away_team_observed_goals
-):
-    number_of_sims_matching_actual_score = len(
-        df_match_outcomes[
-            (df_match_outcomes["home_goals"] == home_team_observed_goals)
-            & (df_match_outcomes["away_goals"] == away_team_observed_goals)
-        ]
-    )
-    percentage_of_sims_matching_actual_score = (
-        number_of_sims_matching_actual_score / N_SIMS
-    )
+    observed_score = ""
+    exact_scoreline = ""
+    if show_observed_score:
+        observed_score = (
+            "\n\nActual outcome: "
+            + home_team
+            + " "
+            + f"{home_team_observed_goals:.0f}"
+            + " - "
+            + away_team
+            + " "
+            + f"{away_team_observed_goals:.0f}"
+        )
+        exact_scoreline = (
+            "\nExact scoreline observed in "
+            + f"{percentage_of_sims_matching_actual_score:.1%}"
+            + " simulations"
+        )
 
-    df_grouped = (
-        df_match_outcomes[["match_outcome", "home_goals"]]
-        .groupby("match_outcome")
-        .count()
+    return (
+        "<"
+        + plot_title
+        + ">"
+        + date_str
+        + observed_score
+        + "\n\n<Home team wins> in "
+        + simulated_home_win_percent
+        + " of simulations\n<Away team wins> in "
+        + simulated_away_win_percent
+        + " of simulations\n<Match is drawn> in "
+        + simulated_draw_percent
+        + " of simulations"
+        + exact_scoreline
+        + "\n\n"
+        + extra_plot_comment
     )
-    df_grouped.columns = ["count"]
-    df_grouped = df_grouped.reindex(["Home win", "Draw", "Away win"])
 
-    df_grouped["proportion"] = df_grouped["count"] / df_grouped["count"].sum()
 
-    df_grouped["percentage"] = (
-        df_grouped["proportion"].astype(float).map("{:.1%}".format)
-    )
+def get_footer_text(source=None, app_url=None):
+    footer_lines = [app_url] if app_url else []
+    footer_lines.append("Built by @lyonjust")
 
-    df_grouped = df_grouped[["percentage"]]
+    if source == "fotmob":
+        footer_lines.append("Data courtesy of FotMob")
 
-    simulated_home_win_percent = df_grouped.loc["Home win", "percentage"]
-    simulated_away_win_percent = df_grouped.loc["Away win", "percentage"]
-    simulated_draw_percent = df_grouped.loc["Draw", "percentage"]
-
-    return (
-        simulated_home_win_percent,
-        simulated_away_win_percent,
-        simulated_draw_percent,
-        percentage_of_sims_matching_actual_score,
-    )
+    return "\n".join(footer_lines)
 
 
+@metrics.instrument("plot_margins")
 def plot_margins(
-    df_match_outcomes,
+    match_outcomes,
     home_team_observed_goals,
     away_team_observed_goals,
     simulated_home_win_percent,
@@ -141,11 +139,30 @@ def plot_margins(
     source=None,
     app_url=None,
 ):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+    import pandas as pd
+    import seaborn as sns
+    from highlight_text import fig_text
+
+    home_margins, proportions = get_margin_distribution(
+        get_score_matrix(match_outcomes)
+    )
+
+    df_margins = pd.DataFrame(
+        {
+            "home_margin": home_margins,
+            "match_outcome": get_outcome_labels(home_margins),
+            "proportion": proportions,
+        }
+    )
+
     fig, ax = plt.subplots(nrows=3, figsize=(8, 8), height_ratios=[8.5, 12, 3.5])
 
     sns.histplot(
-        data=df_match_outcomes,
+        data=df_margins[df_margins["proportion"] > 0],
         x="home_margin",
+        weights="proportion",
         discrete=True,
         stat="density",
         hue="match_outcome",
@@ -166,54 +183,25 @@ def plot_margins(
 
     ax[1].yaxis.set_major_formatter(mtick.PercentFormatter(1, 0))
 
-    plot_title = (
-        home_team
-        + " (home) "
-        + f"{total_home_xg:.2f}"
-        + " xG - "
-        + away_team
-        + " (away) "
-        + f"{total_away_xg:.2f}"
-        + " xG"
-    )
-
-    if match_date:
-        date_str = "\n" + f"{match_date:%d %B %Y}" + "\n"
-    else:
-        date_str = "\n"
-
     title = fig_text(
         x=0.12,
         y=0.9,
-        s="<"
-        + plot_title
-        + ">"
-        + date_str
-        + "\n\nActual outcome: "
-        + home_team
-        + " "
-        + f"{home_team_observed_goals:.0f}"
-        + " - "
-        + away_team
-        + " "
-        + f"{away_team_observed_goals:.0f}"
-        + "\n\n<Home team wins> in "
-        + simulated_home_win_percent
-        + " of simulations\n<Away team wins> in "
-        + simulated_away_win_percent
-        + " of simulations\n<Match is drawn> in "
-        + simulated_draw_percent
-        + " of simulations\nExact scoreline observed in "
-        + f"{percentage_of_sims_matching_actual_score:.1%}"
-        + " simulations\n\n"
-        + extra_plot_comment,
+        s=get_margins_title(
+            home_team_observed_goals,
+            away_team_observed_goals,
+            simulated_home_win_percent,
+            simulated_draw_percent,
+            simulated_away_win_percent,
+            percentage_of_sims_matching_actual_score,
+            total_home_xg,
+            total_away_xg,
+            match_date,
+            home_team,
+            away_team,
+            extra_plot_comment,
+        ),
         fontsize=14,
-        highlight_textprops=[
-            {"weight": "bold"},
-            {"color": outcome_colours["Home win"], "weight": "bold"},
-            {"color": outcome_colours["Away win"], "weight": "bold"},
-            {"color": outcome_colours["Draw"], "weight": "bold"},
-        ],
+        highlight_textprops=MARGINS_TITLE_HIGHLIGHTS,
     )
 
     text_areas = [t for i, t in enumerate(title.text_areas) if i != 1]
@@ -233,11 +221,7 @@ def plot_margins(
 
     title_string = title_string + "\n\n"
 
-    footer_text = app_url
-    footer_text = footer_text + "\nBuilt by @lyonjust"
-
-    if source == "fotmob":
-        footer_text = footer_text + "\nData courtesy of FotMob"
+    footer_text = get_footer_text(source, app_url)
 
     ax[2].text(
         x=0.99, y=0, s=footer_text, horizontalalignment="right", fontstyle="italic"
@@ -245,26 +229,115 @@ def plot_margins(
 
     fig.tight_layout()
 
-    fig.savefig(io, format="png")
+    with metrics.timed("png_encoding"):
+        fig.savefig(io, format="png")
 
     return fig, ax, title_string
 
 
-def plot_exact_scores(df_match_outcomes):
-    df_possible_scores = (
-        df_match_outcomes[["final_score", "home_margin", "home_goals", "match_outcome"]]
-        .groupby(["final_score", "home_margin", "match_outcome"])
-        .count()
-        .reset_index()
-        .sort_values("home_goals", ascending=False)
-    )
-    df_possible_scores.columns = [
-        "final_score",
-        "home_margin",
-        "match_outcome",
-        "simulations",
+@metrics.instrument("plot_timeline")
+def plot_timeline(timeline, home_team="Home team", away_team="Away team"):
+    """
+    Plots a timeline from get_timeline: who is ahead on the chances taken so far and, if the actual score is included,
+    the final outcome probabilities given the score so far and the chances still to come
+    """
+
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+
+    live = "home_win" in timeline
+
+    fig, ax = plt.subplots(nrows=2 if live else 1, figsize=(8, 7 if live else 3.5))
+    ax = np.atleast_1d(ax)
+
+    # probabilities hold until the next minute with a shot
+    minutes = np.append(timeline["minute"], max(timeline["minute"][-1], 90))
+
+    panels = [
+        (
+            ax[0],
+            "Ahead on chances taken so far",
+            [
+                (timeline["home_leading"], home_team + " ahead", "Home win"),
+                (timeline["level"], "Level", "Draw"),
+                (timeline["away_leading"], away_team + " ahead", "Away win"),
+            ],
+        )
     ]
-    df_possible_scores["percent"] = df_possible_scores["simulations"] / N_SIMS
+    if live:
+        panels.append(
+            (
+                ax[1],
+                "Final result given the score so far and the chances to come",
+                [
+                    (timeline["home_win"], home_team + " win", "Home win"),
+                    (timeline["draw"], "Draw", "Draw"),
+                    (timeline["away_win"], away_team + " win", "Away win"),
+                ],
+            )
+        )
+
+    for axis, title, series in panels:
+        axis.stackplot(
+            minutes,
+            *[np.append(values, values[-1]) for values, _, _ in series],
+            labels=[label for _, label, _ in series],
+            colors=[outcome_colours[outcome] for _, _, outcome in series],
+            step="post",
+        )
+        axis.set_title(title, loc="left", fontsize=12, pad=14)
+        axis.set_xlim(0, minutes[-1])
+        axis.set_ylim(0, 1)
+        axis.yaxis.set_major_formatter(mtick.PercentFormatter(1, 0))
+        axis.spines["top"].set_visible(False)
+        axis.spines["right"].set_visible(False)
+        axis.legend(loc="upper left", bbox_to_anchor=(1, 1), frameon=False)
+
+    if live:
+        goals = np.flatnonzero(
+            np.diff(timeline["home_goals"] + timeline["away_goals"]) > 0
+        )
+        for k in goals + 1:
+            ax[1].axvline(timeline["minute"][k], color="white", linestyle="--")
+            ax[1].text(
+                timeline["minute"][k],
+                1.01,
+                f"{timeline['home_goals'][k]}-{timeline['away_goals'][k]}",
+                horizontalalignment="center",
+                fontsize=9,
+            )
+
+    ax[-1].set_xlabel("Minute")
+
+    fig.tight_layout()
+
+    return fig, ax
+
+
+@metrics.instrument("plot_exact_scores")
+def plot_exact_scores(match_outcomes, min_percent=1 / N_SIMS):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+    import pandas as pd
+    import seaborn as sns
+
+    score_matrix = get_score_matrix(match_outcomes)
+
+    home_goals, away_goals = np.nonzero(
+        score_matrix / score_matrix.sum() >= min_percent
+    )
+    home_margin = home_goals - away_goals
+
+    df_possible_scores = pd.DataFrame(
+        {
+            "final_score": [
+                f"{home} - {away}" for home, away in zip(home_goals, away_goals)
+            ],
+            "home_margin": home_margin,
+            "match_outcome": get_outcome_labels(home_margin),
+            "percent": score_matrix[home_goals, away_goals] / score_matrix.sum(),
+        }
+    ).sort_values("percent", ascending=False)
 
     fig_y_length = len(df_possible_scores) / 4
 
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+
+from functions import core
+
+POINTS_FOR_WIN = 3
+POINTS_FOR_DRAW = 1
+
+
+def get_expected_points(home_win, draw, away_win):
+    """
+    Converts match outcome probabilities into expected points (xPts) for the home and away team
+    """
+
+    draw = np.asarray(draw)
+
+    home_xpts = POINTS_FOR_WIN * np.asarray(home_win) + POINTS_FOR_DRAW * draw
+    away_xpts = POINTS_FOR_WIN * np.asarray(away_win) + POINTS_FOR_DRAW * draw
+
+    return home_xpts, away_xpts
+
+
+def get_points(home_goals, away_goals):
+    """
+    Returns the points won by the home and away team for scores given as arrays of any shape
+    """
+
+    home_points = np.where(
+        home_goals > away_goals,
+        POINTS_FOR_WIN,
+        np.where(home_goals == away_goals, POINTS_FOR_DRAW, 0),
+    )
+    away_points = np.where(
+        away_goals > home_goals,
+        POINTS_FOR_WIN,
+        np.where(home_goals == away_goals, POINTS_FOR_DRAW, 0),
+    )
+
+    return home_points, away_points
+
+
+def get_xpts_table(df_results):
+    """
+    Aggregates per-match results (as written by batch.py simulate) into a league table sorted by expected points
+    Actual points are included when the actual score of every match is known
+    """
+
+    home_xpts, away_xpts = get_expected_points(
+        df_results["home_win"], df_results["draw"], df_results["away_win"]
+    )
+
+    df_home = pd.DataFrame(
+        {
+            "team": df_results["home_team"],
+            "xG": df_results["home_xg"],
+            "xGA": df_results["away_xg"],
+            "xPts": home_xpts,
+            "goals": df_results["home_goals"],
+            "goals_against": df_results["away_goals"],
+        }
+    )
+    df_away = pd.DataFrame(
+        {
+            "team": df_results["away_team"],
+            "xG": df_results["away_xg"],
+            "xGA": df_results["home_xg"],
+            "xPts": away_xpts,
+            "goals": df_results["away_goals"],
+            "goals_against": df_results["home_goals"],
+        }
+    )
+
+    df_team_matches = pd.concat([df_home, df_away], ignore_index=True)
+
+    if df_team_matches["goals"].notna().all():
+        df_team_matches["points"], _ = get_points(
+            df_team_matches["goals"].to_numpy(),
+            df_team_matches["goals_against"].to_numpy(),
+        )
+
+    aggregations = {
+        "matches": ("xPts", "size"),
+        "xG": ("xG", "sum"),
+        "xGA": ("xGA", "sum"),
+        "xPts": ("xPts", "sum"),
+    }
+    if "points" in df_team_matches:
+        aggregations["points"] = ("points", "sum")
+
+    df_table = df_team_matches.groupby("team").agg(**aggregations)
+
+    return df_table.sort_values("xPts", ascending=False)
+
+
+def sample_goals(goal_distributions, random):
+    """
+    Samples goals for many matches at once by inverting each row's cumulative distribution
+    random is a (matches x sims) array of uniform draws, and the result has the same shape
+    """
+
+    number_of_matches, number_of_scores = goal_distributions.shape
+
+    # offsetting row k by k makes the concatenated cumulative distributions one sorted array,
+    # so every match can be sampled with a single searchsorted call
+    offsets = np.arange(number_of_matches)[:, np.newaxis]
+    cumulative = np.cumsum(goal_distributions, axis=1) + offsets
+
+    goals = (
+        np.searchsorted(cumulative.ravel(), random + offsets, side="right")
+        - offsets * number_of_scores
+    )
+
+    # guard against rounding leaving a row's total probability just below one
+    return np.minimum(goals, number_of_scores - 1)
+
+
+def simulate_season(
+    home_teams,
+    away_teams,
+    home_goal_distributions,
+    away_goal_distributions,
+    number_of_sims=10000,
+    seed=core.SEED,
+):
+    """
+    Jointly simulates every match of a season from each team's goal distribution (see core.get_goal_distributions)
+    Teams are ranked on points, then goal difference, then goals scored, with remaining ties broken at random
+    Returns a DataFrame with the probability of each team finishing in each position
+    """
+
+    season_rng = core.get_generator(
+        core.get_seed_sequence(
+            seed,
+            tuple(str(team) for team in home_teams),
+            tuple(str(team) for team in away_teams),
+            np.asarray(home_goal_distributions).tobytes(),
+            np.asarray(away_goal_distributions).tobytes(),
+        )
+    )
+
+    teams, team_indices = np.unique(
+        np.concatenate([home_teams, away_teams]), return_inverse=True
+    )
+    home_indices, away_indices = np.split(team_indices, 2)
+    number_of_teams = len(teams)
+
+    home_goals = sample_goals(
+        home_goal_distributions, season_rng.random((len(home_teams), number_of_sims))
+    )
+    away_goals = sample_goals(
+        away_goal_distributions, season_rng.random((len(away_teams), number_of_sims))
+    )
+    home_points, away_points = get_points(home_goals, away_goals)
+
+    # (teams x matches) indicators of which team played each match, so per-team totals are matrix products
+    home_matches = np.equal.outer(np.arange(number_of_teams), home_indices).astype(
+        float
+    )
+    away_matches = np.equal.outer(np.arange(number_of_teams), away_indices).astype(
+        float
+    )
+
+    points = home_matches @ home_points + away_matches @ away_points
+    goals_scored = home_matches @ home_goals + away_matches @ away_goals
+    goals_conceded = home_matches @ away_goals + away_matches @ home_goals
+    goal_difference = goals_scored - goals_conceded
+
+    tie_break = season_rng.random((number_of_teams, number_of_sims))
+
+    # lexsort uses the last key as the primary key, and sorts ascending
+    order = np.lexsort((-tie_break, -goals_scored, -goal_difference, -points), axis=0)
+
+    positions = np.empty_like(order)
+    np.put_along_axis(
+        positions, order, np.arange(number_of_teams)[:, np.newaxis], axis=0
+    )
+
+    position_counts = np.bincount(
+        (
+            np.arange(number_of_teams)[:, np.newaxis] * number_of_teams + positions
+        ).ravel(),
+        minlength=number_of_teams * number_of_teams,
+    ).reshape(number_of_teams, number_of_teams)
+
+    df_positions = pd.DataFrame(
+        position_counts / number_of_sims,
+        index=pd.Index(teams, name="team"),
+        columns=np.arange(1, number_of_teams + 1),
+    )
+    df_positions.insert(0, "mean_points", points.mean(axis=1))
+
+    return df_positions.sort_values("mean_points", ascending=False)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import batch
+from functions import core
+
+# home shots have no possession IDs; two of the three away shots share one (a shot and its rebound)
+SHOTS = pd.DataFrame(
+    {
+        "match_id": [1, 1, 1, 1, 1, 1],
+        "team": ["A", "A", "A", "B", "B", "B"],
+        "venue": ["home", "home", "home", "away", "away", "away"],
+        "xG": [0.4, 0.3, 0.2, 0.3, 0.2, 0.1],
+        "outcome": ["Goal", "Goal", "Miss", "Miss", "Miss", "Miss"],
+        "possession": ["", "", "", "7", "7", None],
+    }
+)
+
+
+def get_expected_score_probability():
+    home = core.get_goal_distribution([0.4, 0.3, 0.2])
+    away = core.get_goal_distribution([1 - (1 - 0.3) * (1 - 0.2), 0.1])
+    return home[2] * away[0]
+
+
+@pytest.fixture
+def shots_path(tmp_path):
+    path = tmp_path / "shots.csv"
+    SHOTS.to_csv(path, index=False)
+    return path
+
+
+def run_simulate(shots, tmp_path):
+    output = tmp_path / "results.csv"
+    batch.main(["simulate", str(shots), "--output", str(output)])
+    return pd.read_csv(output)
+
+
+def test_missing_possession_ids_are_separate_chances(shots_path, tmp_path):
+    results = run_simulate(shots_path, tmp_path)
+
+    assert results.loc[0, "home_goals"] == 2
+    assert results.loc[0, "actual_score_probability"] == pytest.approx(
+        get_expected_score_probability()
+    )
+
+
+def test_shot_store_matches_shots_file(shots_path, tmp_path):
+    store = tmp_path / "store"
+    batch.main(["store", "--shots", str(shots_path), "--output", str(store)])
+
+    from_file = run_simulate(shots_path, tmp_path)
+    from_store = run_simulate(store, tmp_path)
+
+    pd.testing.assert_frame_equal(from_file, from_store)
+    assert np.isclose(
+        from_store.loc[0, "actual_score_probability"], get_expected_score_probability()
+    )